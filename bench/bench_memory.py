@@ -0,0 +1,54 @@
+#! /usr/bin/env python
+# Copyright 2026 Peter Williams
+# Licensed under the GNU General Public License version 3 or higher
+
+"""usage: bench_memory.py [nrecords=100000]
+
+Report the memory retained by `nrecords` parsed records, as measured with
+tracemalloc, when they're stored as plain Holders and as CompactHolders.
+The records come from a generated synthetic data directory."""
+
+from __future__ import absolute_import, division, print_function
+
+import io, os, shutil, sys, tempfile, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from inifile import readStream
+from synth import make_datadir
+
+
+def measure(paths, nrecords, compact):
+    tracemalloc.start()
+    records = []
+
+    for p in paths:
+        with io.open(p, 'rt', encoding='utf-8') as f:
+            records.extend(readStream(f, compact=compact))
+        if len(records) >= nrecords:
+            break
+
+    del records[nrecords:]
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(records), current
+
+
+def main(argv):
+    nrecords = int(argv[1]) if len(argv) > 1 else 100000
+    datadir = tempfile.mkdtemp(prefix='wlbench')
+
+    try:
+        # ~650 bytes per synthetic record on disk; leave some slack.
+        paths = make_datadir(datadir, size_mb=nrecords * 800 / 1024. / 1024)
+
+        for compact, desc in ((False, 'Holder'), (True, 'CompactHolder')):
+            n, nbytes = measure(paths, nrecords, compact)
+            print('%-13s: %7.1f MB per 100k records (%d records measured)' %
+                  (desc, nbytes * 1e5 / n / 1024 / 1024, n))
+    finally:
+        shutil.rmtree(datadir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,119 @@
+# Copyright 2026 Peter Williams
+# Licensed under the GNU General Public License version 3 or higher
+
+"""Generate synthetic worklog data directories for benchmarking.
+
+The records mimic the field conventions of the example data: [pub] records
+with long wrapped author lists, quoted values containing pound signs,
+comments, and a sprinkling of [talk], [prop] and [repo] records. Files are
+partitioned by year, like ``2012.txt``, ``2013.txt``."""
+
+from __future__ import absolute_import, division, print_function
+
+import io, os, random
+
+_surnames = ('Williams Berger Bower Cenko Chomiuk Fong Kamble Margutti '
+             'Metzger Nakar Soderberg Zauderer Alexander Blanchard Eftekhari '
+             'Villar Gomez_de_Castro Hallinan Bloom Croft').split()
+
+
+def _wrap(key, words, outlines):
+    line = key + ' ='
+    for w in words:
+        if len(line) + len(w) + 1 > 78:
+            outlines.append(line)
+            line = ' '
+        line += ' ' + w
+    outlines.append(line)
+
+
+def _pub(rng, year, out):
+    nauth = rng.choice((1, 3, 5, 12, 40, 300))
+    authors = []
+    for i in range(nauth):
+        authors.append('%s. %s;' % (chr(65 + rng.randrange(26)),
+                                    rng.choice(_surnames)))
+    authors[-1] = authors[-1][:-1]
+    month = rng.randrange(1, 13)
+    out.append('[pub]')
+    _wrap('title', ('A study of the transient radio source number %d in the '
+                    'nearby universe' % rng.randrange(10**6)).split(), out)
+    _wrap('authors', authors, out)
+    out.append('mypos = %d' % rng.randrange(1, nauth + 1))
+    out.append('pubdate = %04d/%02d' % (year, month))
+    out.append('bibcode = %04dApJ...%03d..%03dW # for ADS' %
+               (year, rng.randrange(1000), rng.randrange(1000)))
+    out.append('cite = "ApJ %d, %d #%d"' % (rng.randrange(900),
+                                             rng.randrange(200),
+                                             rng.randrange(9)))
+    out.append('refereed = %s' % rng.choice('yn'))
+    out.append('adscites = %04d/%02d/01 %d' % (year + 1, month,
+                                               rng.randrange(500)))
+    out.append('')
+
+
+def _talk(rng, year, out):
+    out.append('[talk]')
+    out.append('date = %04d %s' % (year, rng.choice(
+        'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split())))
+    out.append('where = "At AAS Meeting #%d"' % rng.randrange(300))
+    _wrap('what', ('Radio observations of things we found in the sky '
+                   'during observing run %d' % rng.randrange(1000)).split(), out)
+    out.append('invited = %s' % rng.choice('yn'))
+    out.append('')
+
+
+def _prop(rng, year, out):
+    out.append('[prop]')
+    out.append('title = Observations of source %d' % rng.randrange(10**5))
+    out.append('date = %04d/%02d' % (year, rng.randrange(1, 13)))
+    out.append('facil = VLA')
+    out.append('request = %d hr' % rng.randrange(1, 50))
+    out.append('mepi = y')
+    out.append('accepted = %s' % rng.choice('yn'))
+    out.append('')
+
+
+def _repo(rng, year, out):
+    out.append('[repo]')
+    out.append('name = someone/project%d' % rng.randrange(10**5))
+    out.append('service = github')
+    allc = rng.randrange(1, 5000)
+    out.append('usercommits = %d' % rng.randrange(1, allc + 1))
+    out.append('allcommits = %d' % allc)
+    out.append('lastusercommit = %04d/%02d/%02d' % (year, rng.randrange(1, 13),
+                                                    rng.randrange(1, 29)))
+    out.append('stars = %d' % rng.randrange(100))
+    out.append('')
+
+
+def make_datadir(path, size_mb=50, nfiles=30, seed=0):
+    """Fill the directory `path` with roughly `size_mb` megabytes of
+    synthetic data spread over `nfiles` per-year files. Returns the list of
+    file paths created."""
+
+    rng = random.Random(seed)
+    makers = (_pub,) * 6 + (_talk,) * 2 + (_prop, _repo)
+    perfile = int(size_mb * 1024 * 1024 / nfiles)
+    paths = []
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    for i in range(nfiles):
+        year = 1990 + i
+        out = ['# -*- conf -*-', '# synthetic data for %d' % year, '']
+        size = 0
+
+        while size < perfile:
+            n = len(out)
+            rng.choice(makers)(rng, year, out)
+            size += sum(len(l) + 1 for l in out[n:])
+
+        p = os.path.join(path, '%04d.txt' % year)
+        with io.open(p, 'wt', encoding='utf-8') as f:
+            f.write(u'\n'.join(out))
+            f.write(u'\n')
+        paths.append(p)
+
+    return paths
@@ -10,8 +10,12 @@ from six.moves import range
 
 import io
 
-__all__ = ('Holder readStream read FileChunk '
-           'mutateStream mutate mutateInPlace').split()
+__all__ = ('Holder CompactHolder readStream read LazyHolder readLazy '
+           'filterRecords MappedHolder readMapped readRaw scanSections '
+           'locateField IncrementalReader readCached cachedInfo '
+           'invalidateCache cleanCache FileChunk mutateStream mutate '
+           'mutateInPlace indexRecords patchRecords Transaction '
+           'recoverTransactions').split()
 
 
 class Holder(object):
@@ -57,81 +61,1239 @@ class Holder(object):
             yield k, v
 
 
-import re, os
+# A more compact record type for when we're holding lots of records in
+# memory. Instead of a per-record __dict__, all of the records of a given
+# section share a table mapping field names to slots, and each record just
+# stores a tuple of values. Field and section names are interned, so each
+# distinct name is stored once.
+
+from six.moves import intern
+
+_MISSING = object()
+
+
+class _KeyTable(object):
+    """The field-name-to-slot mapping shared by all of the CompactHolders of
+    one section. Tables only ever grow, so a record whose values tuple is
+    shorter than the table simply lacks the later fields."""
+
+    __slots__ = ('keys', 'index')
+
+    def __init__(self):
+        self.keys = []
+        self.index = {}
+
+    def slot(self, name):
+        i = self.index.get(name)
+        if i is None:
+            name = intern(name)
+            i = len(self.keys)
+            self.keys.append(name)
+            self.index[name] = i
+        return i
+
+
+_keyTables = {}
+
+
+def _keyTable(section):
+    table = _keyTables.get(section)
+    if table is None:
+        table = _keyTables[section] = _KeyTable()
+    return table
+
+
+def _unpickleCompact(fields):
+    return CompactHolder.fromDict(fields)
+
+
+class CompactHolder(object):
+    """A Holder work-alike that stores its values in a tuple indexed through a
+    per-section _KeyTable. It supports the same API as Holder, including
+    setting arbitrary attributes, but has no __dict__. Copies share their
+    values tuple until one of them is modified."""
+
+    __slots__ = ('_table', '_values')
+
+    def __init__(self, **kwargs):
+        object.__setattr__(self, '_table', _keyTable(kwargs.get('section')))
+        object.__setattr__(self, '_values', ())
+        self.set(**kwargs)
+
+    @classmethod
+    def fromDict(cls, fields):
+        section = fields.get('section')
+        if section is not None:
+            section = fields['section'] = intern(section)
+
+        table = _keyTable(section)
+        values = [_MISSING] * len(table.keys)
+
+        for k, v in fields.items():
+            i = table.slot(k)
+            if i >= len(values):
+                values.extend([_MISSING] * (i + 1 - len(values)))
+            values[i] = v
+
+        new = cls.__new__(cls)
+        object.__setattr__(new, '_table', table)
+        object.__setattr__(new, '_values', tuple(values))
+        return new
+
+    def _items(self):
+        for k, v in zip(self._table.keys, self._values):
+            if v is not _MISSING:
+                yield k, v
+
+    def __reduce__(self):
+        return (_unpickleCompact, (dict(self._items()),))
+
+    def __getattr__(self, name):
+        if name in CompactHolder.__slots__:
+            raise AttributeError(name)
+
+        i = self._table.index.get(name)
+        if i is not None and i < len(self._values):
+            v = self._values[i]
+            if v is not _MISSING:
+                return v
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self.setone(name, value)
+
+    def __str__(self):
+        d = dict(self._items())
+        s = sorted(d.keys())
+        return '{' + ', '.join('%s=%s' % (k, d[k]) for k in s) + '}'
+
+    def __repr__(self):
+        d = dict(self._items())
+        s = sorted(d.keys())
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (k, d[k]) for k in s))
+
+    def set(self, **kwargs):
+        table = self._table
+        values = list(self._values)
+
+        for k, v in kwargs.items():
+            i = table.slot(k)
+            if i >= len(values):
+                values.extend([_MISSING] * (i + 1 - len(values)))
+            values[i] = v
+
+        object.__setattr__(self, '_values', tuple(values))
+        return self
+
+    def get(self, name, defval=None):
+        i = self._table.index.get(name)
+        if i is not None and i < len(self._values):
+            v = self._values[i]
+            if v is not _MISSING:
+                return v
+        return defval
+
+    def setone(self, name, value):
+        i = self._table.slot(name)
+        values = self._values
+
+        if i < len(values):
+            values = values[:i] + (value,) + values[i + 1:]
+        else:
+            values = values + (_MISSING,) * (i - len(values)) + (value,)
+
+        object.__setattr__(self, '_values', values)
+        return self
+
+    def has(self, name):
+        return self.get(name, _MISSING) is not _MISSING
+
+    def copy(self):
+        new = self.__class__.__new__(self.__class__)
+        object.__setattr__(new, '_table', self._table)
+        object.__setattr__(new, '_values', self._values)
+        return new
+
+    def iteritems(self):
+        for k, v in self._items():
+            if k[0] == '_':
+                continue
+            if v is None:
+                continue
+            yield k, v
+
+
+import contextlib, hashlib, re, os
 
 sectionre = re.compile(r'^\[(.*)]\s*$')
 keyre = re.compile(r'^(\S+)\s*= (.*)$') # leading space chomped later
 escre = re.compile(r'^(\S+)\s*=\s*"(.*)"\s*$')
 
-def readStream(stream):
-    section = None
-    key = None
-    data = None
 
-    for fullline in stream:
-        line = fullline.split('#', 1)[0]
+def _makeHolder(fields):
+    h = Holder()
+    h.__dict__ = fields
+    return h
+
+
+def _hashRecord(text):
+    """Compute the fingerprint of a record from its text (str or UTF-8 bytes),
+    running from the start of its header line to the start of the next
+    record's header, or the end of the file."""
+
+    if isinstance(text, text_type):
+        text = text.encode('utf-8')
+    elif b'\r' in text:
+        # Match what text-mode reading, with universal newlines, would see.
+        text = text.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+
+    if not text.endswith(b'\n'):
+        text += b'\n'
+    return hashlib.blake2b(text, digest_size=8).hexdigest()
+
+
+def _sectionSet(sections):
+    if sections is None:
+        return None
+    if isinstance(sections, string_types):
+        return frozenset((sections,))
+    return frozenset(sections)
+
+
+def _matches(get, where):
+    """Check whether a record passes the `where` filter used by the reading
+    functions, given its `get` method. See readStream()."""
+
+    for name, want in where.items():
+        value = get(name)
+        if value is None:
+            return False
+        if callable(want):
+            if not want(value):
+                return False
+        elif value != want:
+            return False
+    return True
+
+
+def _parseLines(lines, compact=False, sections=None, where=None):
+    """Parse records out of the sequence of lines `lines` (without line
+    terminators), yielding a Holder for each one, or a CompactHolder if
+    `compact`.
+
+    Each line is classified by its first character, so that at most one regex
+    is run per line. Multi-line values are collected into a list that is
+    joined once the value is complete, which keeps long wrapped fields (e.g.
+    big author lists) linear-time.
+
+    Each record gets a `_fingerprint` attribute, a hash of its text. It
+    changes whenever the record's text does, including comments and the
+    blank lines following it.
+
+    Records whose section isn't in `sections` (a frozenset, or None for
+    all) are skipped over without looking at their fields. Records that
+    don't pass the `where` filter are dropped before a Holder is made."""
+
+    makeHolder = CompactHolder.fromDict if compact else _makeHolder
+    fields = None
+    key = None
+    parts = None
+    start = 0
+    skipping = False
+
+    for i, fullline in enumerate(lines):
+        if skipping and fullline[:1] != '[':
+            continue
+
+        if '#' in fullline:
+            line = fullline.split('#', 1)[0]
+        else:
+            line = fullline
+
+        first = line[:1]
+
+        if first == '[':
+            m = sectionre.match(line)
+            if m is not None:
+                # New section
+                if fields is not None:
+                    if key is not None:
+                        fields[key] = ''.join(parts).strip()
+                        key = parts = None
+                    if where is None or _matches(fields.get, where):
+                        text = '\n'.join(lines[start:i]) + '\n'
+                        fields['_fingerprint'] = _hashRecord(text)
+                        yield makeHolder(fields)
+
+                skipping = sections is not None and m.group(1) not in sections
+                if skipping:
+                    fields = None
+                    continue
+
+                fields = {'section': m.group(1)}
+                start = i
+                continue
+            elif skipping:
+                continue
+
+        if not line.strip():
+            if key is not None:
+                fields[key] = ''.join(parts).strip()
+                key = parts = None
+            continue
+
+        if first in ' \t':
+            if key is None:
+                raise Exception('unparsable line: ' + line)
+            parts.append(line.strip() + ' ')
+            continue
+
+        if '"' in fullline:
+            m = escre.match(fullline)
+            if m is not None:
+                if fields is None:
+                    raise Exception('key seen without section!')
+                if key is not None:
+                    fields[key] = ''.join(parts).strip()
+                key = parts = None
+                fields[m.group(1)] = (m.group(2).replace(r'\"', '"')
+                                      .replace(r'\n', '\n').replace(r'\\', '\\'))
+                continue
+
+        m = keyre.match(line)
+        if m is not None:
+            if fields is None:
+                raise Exception('key seen without section!')
+            if key is not None:
+                fields[key] = ''.join(parts).strip()
+            key = m.group(1)
+            data = m.group(2)
+            if not len(data):
+                data = ' '
+            elif data[-1] not in ' \t\r\n':
+                data += ' '
+            parts = [data]
+            continue
+
+        raise Exception('unparsable line: ' + line)
+
+    if fields is not None:
+        if key is not None:
+            fields[key] = ''.join(parts).strip()
+        if where is None or _matches(fields.get, where):
+            fields['_fingerprint'] = _hashRecord('\n'.join(lines[start:]))
+            yield makeHolder(fields)
+
+
+def readStream(stream, compact=False, sections=None, where=None):
+    """Parse records out of `stream`, yielding a Holder for each one, or a
+    CompactHolder if `compact`. The stream is read in one go.
+
+    If `sections` is given, as a section name or a collection of them, only
+    records in those sections are yielded; the others are skipped without
+    being parsed, or checked for errors. `where` is a dict mapping field
+    names to either a value, which the field must equal, or a function that
+    takes the field's value and returns whether the record should be
+    yielded. Records without all of the fields in `where` are skipped."""
+    return _parseLines(stream.read().split('\n'), compact=compact,
+                       sections=_sectionSet(sections), where=where)
+
+
+# Data files may be compressed, as indicated by their names. We
+# (de)compress them on the fly when streaming through them, but they can't
+# be memory-mapped, so the byte-level machinery below falls back to
+# working on the decompressed text.
+
+_compressedSuffixes = (('.gz', 'gzip'), ('.bz2', 'bz2'), ('.xz', 'lzma'))
+
+
+def _compression(path):
+    """Return the name of the module handling the compression of the data
+    file at `path`, or None if it isn't compressed."""
+
+    for suffix, modname in _compressedSuffixes:
+        if path.endswith(suffix):
+            return modname
+    return None
+
+
+def _openText(path, mode='rt', like=None):
+    """Open the data file at `path`, which may also be a binary file object,
+    in text mode `mode`. If its name -- or `like`, if given -- says that it's
+    compressed, it's compressed or decompressed on the fly."""
+
+    import importlib
+
+    modname = _compression(like or path)
+    if modname is not None:
+        return importlib.import_module(modname).open(path, mode)
+    if isinstance(path, string_types):
+        return io.open(path, mode)
+    return io.TextIOWrapper(path)
+
+
+def read(stream_or_path, lazy=False, compact=False, sections=None, where=None):
+    if isinstance(stream_or_path, string_types):
+        stream_or_path = _openText(stream_or_path)
+
+    if lazy:
+        return readLazy(stream_or_path, sections=sections, where=where)
+    return readStream(stream_or_path, compact=compact, sections=sections, where=where)
+
+
+def _fingerprintIndex(path, fingerprint):
+    """Find the position in the data file at `path` of the first record whose
+    `_fingerprint` is `fingerprint`, or None."""
+
+    n = -1
+    lines = None
+
+    with _openText(path) as stream:
+        for fullline in stream:
+            line = fullline.split('#', 1)[0]
+
+            if line[:1] == '[' and sectionre.match(line) is not None:
+                if lines is not None and _hashRecord(''.join(lines)) == fingerprint:
+                    return n
+                n += 1
+                lines = []
+
+            if lines is not None:
+                lines.append(fullline)
+
+    if lines is not None and _hashRecord(''.join(lines)) == fingerprint:
+        return n
+    return None
+
+
+def locateField(path, index, name=None):
+    """Find where the `index`'th record (counting from zero) of the data file at
+    `path` is defined, returning a 1-based line number. `index` may also be
+    the record's `_fingerprint`, which is handy when the records have been
+    filtered. If `name` is given and the record sets that field, the line
+    where it does so is returned instead. Returns None if there's no such
+    record. This rereads the file, so it's meant for error messages."""
+
+    if isinstance(index, string_types):
+        index = _fingerprintIndex(path, index)
+        if index is None:
+            return None
+
+    header = None
+    n = -1
+
+    with _openText(path) as stream:
+        for lineno, fullline in enumerate(stream, 1):
+            line = fullline.split('#', 1)[0]
+
+            if line[:1] == '[' and sectionre.match(line) is not None:
+                n += 1
+                if n == index:
+                    header = lineno
+                elif n > index:
+                    break
+                continue
+
+            if n == index and name is not None:
+                m = escre.match(fullline) or keyre.match(line)
+                if m is not None and m.group(1) == name:
+                    return lineno
+
+    return header
+
+
+# Lazy reading. Most of the cost of reading a file is in tokenizing the
+# fields, but plenty of callers only care about certain sections. So we can
+# just find the section headers up front and leave everything else for
+# later.
+
+def _bracketLines(buf):
+    """Yield ``(start, end)`` offsets of every line in `buf` that starts with
+    an open bracket, i.e. every potential section header. `buf` may be text or
+    bytes. Searching for the two-character sequence is much faster than
+    walking every line."""
+
+    if isinstance(buf, text_type):
+        nl, lbrack = '\n', '['
+    else:
+        nl, lbrack = b'\n', b'['
+
+    size = len(buf)
+    needle = nl + lbrack
+
+    if buf[:1] == lbrack:
+        pos = 0
+    else:
+        pos = buf.find(needle)
+        if pos >= 0:
+            pos += 1
+
+    while pos >= 0:
+        eol = buf.find(nl, pos)
+        if eol < 0:
+            eol = size
+        yield pos, eol
+
+        pos = buf.find(needle, eol)
+        if pos >= 0:
+            pos += 1
+
+
+class LazyHolder(Holder):
+    """A Holder that keeps the raw text of its record, `_src`, and only
+    parses it the first time that a field other than `section` is needed.
+
+    Subclasses can change what `_src` is by overriding `_scan()`, which
+    returns a dict mapping each field name to some token, and
+    `_decodeSpan(token)`, which turns a token into the field value. Until
+    it's first accessed, a field lives in `_spans` as its token; here the
+    token is simply the parsed value."""
+
+    __slots__ = ('_src', '_spans')
+
+    def __init__(self, section, src):
+        self._src = src
+        self._spans = None
+        self.section = section
+
+    def _scan(self):
+        fields = next(_parseLines(self._src.split('\n'))).__dict__
+        del fields['section']
+        self._src = None
+        return fields
+
+    def _decodeSpan(self, token):
+        return token
+
+    def _pending(self):
+        if self._spans is None:
+            self._spans = self._scan()
+            for name in self.__dict__:
+                # Values that were set before we scanned win.
+                self._spans.pop(name, None)
+        return self._spans
+
+    def _decode(self, name):
+        value = self._decodeSpan(self._pending().pop(name))
+        self.__dict__[name] = value
+        return value
+
+    def _materialize(self):
+        for name in list(self._pending()):
+            self._decode(name)
+
+    def __getattr__(self, name):
+        if name in ('_src', '_spans') or name not in self._pending():
+            raise AttributeError(name)
+        return self._decode(name)
+
+    def __str__(self):
+        self._materialize()
+        return super(LazyHolder, self).__str__()
+
+    def __repr__(self):
+        self._materialize()
+        return super(LazyHolder, self).__repr__()
+
+    def set(self, **kwargs):
+        if self._spans is not None:
+            for name in kwargs:
+                self._spans.pop(name, None)
+        return super(LazyHolder, self).set(**kwargs)
+
+    def get(self, name, defval=None):
+        if name not in self.__dict__ and name in self._pending():
+            return self._decode(name)
+        return self.__dict__.get(name, defval)
+
+    def setone(self, name, value):
+        if self._spans is not None:
+            self._spans.pop(name, None)
+        self.__dict__[name] = value
+        return self
+
+    def has(self, name):
+        return name in self.__dict__ or name in self._pending()
+
+    def copy(self):
+        self._materialize()
+        return _makeHolder(dict(self.__dict__))
+
+    def iteritems(self):
+        self._materialize()
+        return super(LazyHolder, self).iteritems()
+
+
+def filterRecords(items, sections=None, where=None):
+    """Yield the records in `items` that pass the `sections` and `where`
+    filters described in readStream(). Only the fields named in `where` are
+    looked at, so lazy records stay mostly unparsed."""
+
+    sections = _sectionSet(sections)
+
+    for item in items:
+        if sections is not None and item.section not in sections:
+            continue
+        if where is not None and not _matches(item.get, where):
+            continue
+        yield item
+
+
+def readLazy(stream, sections=None, where=None):
+    """Like readStream(), but yields LazyHolders, which only parse their
+    fields when they're first needed. Records that aren't in `sections` are
+    never parsed, and for the others, only the fields in `where` are needed
+    to decide whether to yield them.
+
+    Note that this means that syntax errors inside a record are only reported
+    when that record's fields are first accessed."""
+
+    return filterRecords(_readLazy(stream), sections, where)
+
+
+def _readLazy(stream):
+    text = stream.read()
+    section = None
+    start = 0
+
+    for pos, eol in _bracketLines(text):
+        m = sectionre.match(text[pos:eol].split('#', 1)[0])
+        if m is None:
+            continue  # some odd key line that's part of the current record
+
+        if section is None:
+            for _ in _parseLines(text[:pos].split('\n')):
+                pass  # just checking for junk before the first record
+        else:
+            yield LazyHolder(section, text[start:pos])
+        section = m.group(1)
+        start = pos
+
+    if section is None:
+        for _ in _parseLines(text.split('\n')):
+            pass
+    else:
+        yield LazyHolder(section, text[start:])
+
+
+# Memory-mapped reading. Here we scan the raw bytes of a file and only
+# remember where each field's value lives; the text is decoded when somebody
+# actually asks for it. Section names are always decoded since pretty much
+# every consumer looks at them.
+
+_bsectionre = re.compile(sectionre.pattern.encode('ascii'))
+_bkeyre = re.compile(keyre.pattern.encode('ascii'))
+_bescre = re.compile(escre.pattern.encode('ascii'))
+
+# Matches every line that is *not* a continuation line: continuations start
+# with a space or tab and contain something other than whitespace before any
+# comment.
+_bheadre = re.compile(br'^(?![ \t][ \t\r\f\v]*[^\s#])[^\n]*', re.M)
+_bspecialfirst = (b'', b'[', b' ', b'\t')
+
+
+def _classifyLine(raw):
+    """Classify one raw line (bytes, no line terminator) the same way that
+    readStream would. Returns a tuple whose first element is one of
+    'section', 'blank', 'cont', 'esc', 'key', or 'bad'. Value offsets are in
+    bytes relative to the start of the line.
+
+    Pure-ASCII lines are handled with bytes regexes; anything else is decoded
+    so that Unicode whitespace is treated exactly as in readStream."""
+
+    if raw.isascii():
+        full = raw
+        hashmark, quote, lbrack, indents = b'#', b'"', b'[', (b' ', b'\t')
+        rsection, rkey, resc = _bsectionre, _bkeyre, _bescre
+        offset = lambda i: i
+    else:
+        full = raw.decode('utf-8')
+        hashmark, quote, lbrack, indents = '#', '"', '[', (' ', '\t')
+        rsection, rkey, resc = sectionre, keyre, escre
+        offset = lambda i: len(full[:i].encode('utf-8'))
+
+    line = full.split(hashmark, 1)[0]
+    first = line[:1]
+
+    if first == lbrack:
+        m = rsection.match(line)
+        if m is not None:
+            name = m.group(1)
+            if not isinstance(name, text_type):
+                name = name.decode('ascii')
+            return ('section', name)
+
+    if not line.strip():
+        return ('blank',)
+
+    if first in indents:
+        return ('cont',)
+
+    if quote in full:
+        m = resc.match(full)
+        if m is not None:
+            key = m.group(1)
+            if not isinstance(key, text_type):
+                key = key.decode('ascii')
+            return ('esc', key, offset(m.start(2)), offset(m.end(2)))
+
+    m = rkey.match(line)
+    if m is not None:
+        key = m.group(1)
+        if not isinstance(key, text_type):
+            key = key.decode('ascii')
+        return ('key', key, offset(m.start(2)))
+
+    return ('bad',)
+
+
+def _scanSpans(buf, start, end, section=True):
+    """Find the value of each field in ``buf[start:end]``, which should be the
+    body of one record (everything after its header line). Returns a dict
+    mapping field names to ``(start, end, quoted)`` byte spans. If `section`
+    is false, we're looking at the stuff before the first record, where only
+    blank lines and comments are allowed."""
+
+    spans = {}
+    key = None
+    vstart = vend = 0
+    expected = start
+    names = {}
+
+    # We only visit the lines that aren't continuations: the regex engine
+    # skips over the (typically numerous) wrapped value lines for us, and we
+    # just note where they end.
+
+    for m in _bheadre.finditer(buf, start, end):
+        pos = m.start()
+
+        if pos > expected:
+            if key is None:
+                eol = buf.find(b'\n', expected, end)
+                raise Exception('unparsable line: ' +
+                                buf[expected:eol].decode('utf-8'))
+            vend = pos - 1
+            if buf[vend - 1:vend] == b'\r':
+                vend -= 1
+
+        raw = m.group()
+        if raw.endswith(b'\r'):
+            raw = raw[:-1]
+        expected = m.end() + 1
+        kind = None
+
+        if raw[:1] not in _bspecialfirst and b'"' not in raw and raw.isascii():
+            # Fast path for the common case of a plain ASCII "key = value".
+            km = _bkeyre.match(raw.split(b'#', 1)[0])
+            if km is not None:
+                kind = 'key'
+                info = (kind, names.get(km.group(1)) or
+                        names.setdefault(km.group(1), km.group(1).decode('ascii')),
+                        km.start(2))
+
+        if kind is None:
+            info = _classifyLine(raw)
+            kind = info[0]
+
+        if kind == 'blank':
+            if key is not None:
+                spans[key] = (vstart, vend, False)
+                key = None
+        elif kind == 'esc':
+            if not section:
+                raise Exception('key seen without section!')
+            if key is not None:
+                spans[key] = (vstart, vend, False)
+                key = None
+            spans[info[1]] = (pos + info[2], pos + info[3], True)
+        elif kind == 'key':
+            if not section:
+                raise Exception('key seen without section!')
+            if key is not None:
+                spans[key] = (vstart, vend, False)
+            key = info[1]
+            vstart = pos + info[2]
+            vend = pos + len(raw)
+        else:
+            raise Exception('unparsable line: ' + raw.decode('utf-8'))
+
+    if expected < end:
+        # Trailing continuation lines with no final newline.
+        if key is None:
+            raise Exception('unparsable line: ' + buf[expected:end].decode('utf-8'))
+        vend = end
+        if buf[vend - 1:vend] == b'\r':
+            vend -= 1
+
+    if key is not None:
+        spans[key] = (vstart, vend, False)
+
+    return spans
+
+
+class MappedHolder(LazyHolder):
+    """A LazyHolder backed by a region of a memory-mapped data file. The first
+    time any field other than `section` is needed, the record's bytes are
+    scanned to find the span of each value; the tokens in `_spans` are
+    ``(start, end, quoted)`` byte offsets into the mapping. Each value is
+    only decoded into text the first time it's accessed.
+
+    `start` is where the record's fields begin; `head`, if given, is where
+    its header line begins, for the purposes of `_fingerprint`."""
+
+    __slots__ = ()
+
+    def __init__(self, buf, section, start, end, head=None):
+        if head is None:
+            head = start
+        super(MappedHolder, self).__init__(section, (buf, start, end, head))
+
+    def _scan(self):
+        buf, start, end, head = self._src
+        spans = _scanSpans(buf, start, end)
+        spans['_fingerprint'] = (head, end, None)
+        return spans
+
+    def _decodeSpan(self, token):
+        start, end, quoted = token
+
+        if quoted is None:
+            return _hashRecord(self._src[0][start:end])
+
+        text = self._src[0][start:end].decode('utf-8')
+
+        if quoted:
+            return text.replace(r'\"', '"').replace(r'\n', '\n').replace(r'\\', '\\')
+
+        lines = text.split('\n')
+        data = lines[0].rstrip('\r').split('#', 1)[0]
+        if not len(data):
+            data = ' '
+        elif data[-1] not in ' \t\r\n':
+            data += ' '
+        parts = [data]
+        for line in lines[1:]:
+            parts.append(line.rstrip('\r').split('#', 1)[0].strip() + ' ')
+        return ''.join(parts).strip()
+
+
+def _mapFile(path):
+    """Memory-map the file at `path` read-only, or return None if it's empty,
+    since empty files can't be mapped."""
+
+    import mmap
+
+    with io.open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _readBuffer(path):
+    """Get the raw contents of the data file at `path` for the byte-level
+    scanning routines: a read-only mapping, or for compressed files, the
+    decompressed bytes. Returns None if the file is empty."""
+
+    import importlib
+
+    modname = _compression(path)
+    if modname is None:
+        return _mapFile(path)
+
+    with importlib.import_module(modname).open(path, 'rb') as f:
+        return f.read() or None
+
+
+def _recordRanges(buf):
+    """Yield ``(section, start, body, end)`` for each record in the mapped file
+    `buf`: its section name, the offset of its header line, the offset of
+    the line after that, and the offset just past its end, which is where
+    the next record's header begins. Anything before the first record is
+    checked for junk."""
+
+    size = len(buf)
+    prev = None
+
+    for pos, eol in _bracketLines(buf):
+        raw = buf[pos:eol]
+        if raw.endswith(b'\r'):
+            raw = raw[:-1]
+
+        info = _classifyLine(raw)
+        if info[0] != 'section':
+            continue  # some odd key line that's part of the current record
+
+        if prev is None:
+            _scanSpans(buf, 0, pos, section=False)
+        else:
+            yield prev + (pos,)
+        prev = (info[1], pos, min(eol + 1, size))
+
+    if prev is None:
+        _scanSpans(buf, 0, size, section=False)
+    else:
+        yield prev + (size,)
+
+
+def readMapped(path, sections=None, where=None):
+    """Like read(), but memory-maps the file at `path` and yields
+    MappedHolders. Only the section headers are examined while reading; each
+    record's fields are located and decoded lazily. The records keep the
+    mapping alive for as long as they exist. `sections` and `where` filter
+    the records as in readLazy().
+
+    Note that this means that syntax errors inside a record are only reported
+    when that record's fields are first accessed.
+
+    Compressed files can't be mapped, so for them this is the same as
+    read(path, lazy=True)."""
+
+    return filterRecords(_readMapped(path), sections, where)
+
+
+def _readMapped(path):
+    if _compression(path) is not None:
+        with _openText(path) as stream:
+            for item in readLazy(stream):
+                yield item
+        return
+
+    buf = _mapFile(path)
+    if buf is None:
+        return
+
+    for section, start, body, end in _recordRanges(buf):
+        yield MappedHolder(buf, section, body, end, start)
+
+
+def readRaw(path):
+    """Yield ``(section, data)`` for each record in the data file at `path`,
+    where `data` is the record's original bytes: its header line and
+    everything up to the next record's header, comments and all. Only the
+    section headers are parsed. Compressed files are decompressed first."""
+
+    buf = _readBuffer(path)
+    if buf is None:
+        return
+
+    try:
+        for section, start, body, end in _recordRanges(buf):
+            yield section, buf[start:end]
+    finally:
+        if not isinstance(buf, bytes):
+            buf.close()
+
+
+def scanSections(path):
+    """Count the records of each section in the data file at `path`, returning
+    a dict mapping section names to counts. Only the section headers are
+    examined, using a byte-level search over the memory-mapped file, so this
+    is about as fast as reading the file can be. No validation of the record
+    contents is done. Compressed files are decompressed and scanned as text."""
+
+    counts = {}
+
+    if _compression(path) is not None:
+        with _openText(path) as stream:
+            for item in readLazy(stream):
+                counts[item.section] = counts.get(item.section, 0) + 1
+        return counts
+
+    buf = _mapFile(path)
+    if buf is None:
+        return counts
+
+    try:
+        for pos, eol in _bracketLines(buf):
+            raw = buf[pos:eol]
+            if raw.endswith(b'\r'):
+                raw = raw[:-1]
+
+            info = _classifyLine(raw)
+            if info[0] == 'section':
+                counts[info[1]] = counts.get(info[1], 0) + 1
+    finally:
+        buf.close()
+
+    return counts
+
+
+# Incremental reparsing. A long-running process that keeps a file's records
+# loaded can refresh them after an edit by hashing each record's bytes
+# (cheap) and only parsing the ones whose hashes it hasn't seen (not so
+# cheap).
+
+class IncrementalReader(object):
+    """Keeps the records of the data file at `path` parsed. Each call to
+    refresh() rereads the file, but only reparses records whose text has
+    changed since the last call; the rest are returned as the very same
+    objects as before. Records are Holders, or CompactHolders if `compact`.
+
+    `ranges` lists the byte range of each record as of the last refresh,
+    `parsed` the records that had to be parsed, and `nparsed` their number."""
+
+    def __init__(self, path, compact=False):
+        self.path = path
+        self.compact = compact
+        self.records = []
+        self.ranges = []
+        self.parsed = []
+        self.nparsed = 0
+        self._stat = None
+
+
+    def refresh(self):
+        """Bring `records` up to date with the file and return it."""
+
+        st = os.stat(self.path)
+        if _statKey(st) == self._stat:
+            self.parsed = []
+            self.nparsed = 0
+            return self.records
+
+        known = {}
+        for item in self.records:
+            known.setdefault(item._fingerprint, []).append(item)
+
+        records = []
+        ranges = []
+        parsed = []
+        buf = _readBuffer(self.path)
+
+        if buf is not None:
+            try:
+                for section, start, body, end in _recordRanges(buf):
+                    raw = buf[start:end]
+                    fingerprint = _hashRecord(raw)
+                    reusable = known.get(fingerprint)
+
+                    if reusable:
+                        item = reusable.pop()
+                    else:
+                        text = raw.decode('utf-8')
+                        if '\r' in text:
+                            text = text.replace('\r\n', '\n').replace('\r', '\n')
+                        item = next(_parseLines(text.split('\n'), compact=self.compact))
+                        parsed.append(item)
+
+                    records.append(item)
+                    ranges.append((start, end))
+            finally:
+                if not isinstance(buf, bytes):
+                    buf.close()
+
+        self.records = records
+        self.ranges = ranges
+        self.parsed = parsed
+        self.nparsed = len(parsed)
+
+        if _trustedMtime(st) is None:
+            self._stat = None
+        else:
+            self._stat = _statKey(st)
+
+        return records
+
+
+# Caching parsed records on disk. Each data file gets a sidecar pickle in a
+# cache directory holding its parsed records, along with the file's mtime,
+# size, and a hash of its contents. (Other information about a data file,
+# such as its record index, can be cached alongside, so long as it starts
+# with the same kind of header.) If the stat info matches we trust the
+# cache outright; if it doesn't but the hash does (e.g., the file was just
+# touched), we still avoid reparsing.
+
+_cacheVersion = 2
+
+
+def _trustedMtime(st):
+    """Get the mtime from the stat info `st`, for saving alongside something
+    derived from the file, or None if it can't be trusted. If the file was
+    modified in the past couple of seconds, it could be modified again within
+    the same mtime tick without the mtime changing, so a later check of the
+    stat info alone wouldn't notice. None never matches a later stat."""
+
+    import time
+
+    if time.time() - st.st_mtime < 2:
+        return None
+    return st.st_mtime_ns
+
+
+def _cachePath(cachedir, path, kind):
+    return os.path.join(cachedir, os.path.basename(path) + '.' + kind)
+
+
+def _writeCache(cpath, header, payload):
+    import pickle
+
+    tmppath = '%s.%d.tmp' % (cpath, os.getpid())
+
+    try:
+        cachedir = os.path.dirname(cpath)
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        with io.open(tmppath, 'wb') as f:
+            pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(payload, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, cpath)
+    except (IOError, OSError):
+        # The cache is just an optimization, so don't fuss if e.g. the data
+        # directory is read-only.
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+
+
+def _cachedHolders(records, compact, sections, where):
+    make = CompactHolder.fromDict if compact else _makeHolder
+    sections = _sectionSet(sections)
+
+    for fields in records:
+        if sections is not None and fields['section'] not in sections:
+            continue
+        if where is not None and not _matches(fields.get, where):
+            continue
+        yield make(fields)
+
+
+def readCached(path, cachedir, compact=False, sections=None, where=None):
+    """Like read(path), but consult and maintain a cache of the parsed records
+    in the directory `cachedir`. Returns an iterator of Holders, or
+    CompactHolders if `compact`. The cache always holds all of the records;
+    `sections` and `where` filter what's returned, as in readStream()."""
+
+    import hashlib, pickle
+
+    cpath = _cachePath(cachedir, path, 'records')
+    st = os.stat(path)
+    header = records = None
+
+    try:
+        with io.open(cpath, 'rb') as cf:
+            header = pickle.load(cf)
+            if header.get('version') != _cacheVersion:
+                header = None
+            elif header['mtime'] == st.st_mtime_ns and header['size'] == st.st_size:
+                records = pickle.load(cf)
+            else:
+                # We may need the records if the contents turn out to be the
+                # same; defer deciding until we've hashed the file.
+                records = cf.read()
+    except Exception:
+        header = records = None
+
+    if header is not None and not isinstance(records, bytes):
+        return _cachedHolders(records, compact, sections, where)
+
+    with io.open(path, 'rb') as f:
+        data = f.read()
+        st = os.fstat(f.fileno())
+
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    if header is not None and header['hash'] == digest:
+        records = pickle.loads(records)
+    else:
+        text = _openText(io.BytesIO(data), like=path)
+        records = [h.__dict__ for h in readStream(text)]
+
+    # If the mtime can't be trusted, the next reader checks the hash.
+    _writeCache(cpath, {'version': _cacheVersion, 'mtime': _trustedMtime(st),
+                        'size': st.st_size, 'hash': digest}, records)
+
+    return _cachedHolders(records, compact, sections, where)
+
+
+def cachedInfo(path, cachedir, kind, compute):
+    """Get some information about the data file at `path`, as computed by
+    `compute(path)`, which must return something picklable. The result is
+    saved in `cachedir` under the name `kind` and reused as long as the
+    file's size and mtime are unchanged."""
+
+    import pickle
 
-        m = sectionre.match(line)
-        if m is not None:
-            # New section
-            if section is not None:
-                if key is not None:
-                    section.setone(key, data.strip())
-                    key = data = None
-                yield section
+    cpath = _cachePath(cachedir, path, kind)
+    st = os.stat(path)
 
-            section = Holder()
-            section.section = m.group(1)
-            continue
+    try:
+        with io.open(cpath, 'rb') as cf:
+            header = pickle.load(cf)
+            if (header.get('version') == _cacheVersion and
+                    header['mtime'] == st.st_mtime_ns and
+                    header['size'] == st.st_size):
+                return pickle.load(cf)
+    except Exception:
+        pass
 
-        if len(line.strip()) == 0:
-            if key is not None:
-                section.setone(key, data.strip())
-                key = data = None
-            continue
+    info = compute(path)
 
-        m = escre.match(fullline)
-        if m is not None:
-            if section is None:
-                raise Exception('key seen without section!')
-            if key is not None:
-                section.setone(key, data.strip())
-            key = m.group(1)
-            data = m.group(2).replace(r'\"', '"').replace(r'\n', '\n').replace(r'\\', '\\')
-            section.setone(key, data)
-            key = data = None
-            continue
+    _writeCache(cpath, {'version': _cacheVersion, 'mtime': _trustedMtime(st),
+                        'size': st.st_size}, info)
+    return info
 
-        m = keyre.match(line)
-        if m is not None:
-            if section is None:
-                raise Exception('key seen without section!')
-            if key is not None:
-                section.setone(key, data.strip())
-            key = m.group(1)
-            data = m.group(2)
-            if not len(data):
-                data = ' '
-            elif data[-1] not in ' \t\r\n':
-                data += ' '
-            continue
 
-        if line[0] in ' \t' and key is not None:
-            data += line.strip() + ' '
-            continue
+def invalidateCache(cachedir, path):
+    """Remove everything cached about the data file `path`, if anything."""
 
-        raise Exception('unparsable line: ' + line[:-1])
+    if not os.path.isdir(cachedir):
+        return
 
-    if section is not None:
-        if key is not None:
-            section.setone(key, data.strip())
-        yield section
+    prefix = os.path.basename(path) + '.'
 
+    for name in os.listdir(cachedir):
+        if name.startswith(prefix) and '.' not in name[len(prefix):]:
+            try:
+                os.unlink(os.path.join(cachedir, name))
+            except OSError:
+                pass
 
-def read(stream_or_path):
-    if isinstance(stream_or_path, string_types):
-        return readStream(io.open(stream_or_path, 'rt'))
-    return readStream(stream_or_path)
+
+def cleanCache(cachedir, datadir, everything=False):
+    """Remove entries from the cache directory `cachedir` whose data files no
+    longer exist in `datadir` or have changed since they were cached. If
+    `everything`, remove the whole cache. Returns the number of entries
+    removed."""
+
+    import pickle, shutil
+
+    if not os.path.isdir(cachedir):
+        return 0
+
+    names = os.listdir(cachedir)
+
+    if everything:
+        shutil.rmtree(cachedir)
+        return len(names)
+
+    nremoved = 0
+
+    for name in names:
+        cpath = os.path.join(cachedir, name)
+        stale = True
+
+        if name.startswith('.') and not name.endswith('.tmp'):
+            continue  # not a record cache entry
+
+        if not name.endswith('.tmp'):
+            try:
+                st = os.stat(os.path.join(datadir, name.rsplit('.', 1)[0]))
+                with io.open(cpath, 'rb') as cf:
+                    header = pickle.load(cf)
+                stale = (header.get('version') != _cacheVersion or
+                         header['size'] != st.st_size or
+                         header['mtime'] not in (None, st.st_mtime_ns))
+            except Exception:
+                pass
+
+        if stale:
+            os.unlink(cpath)
+            nremoved += 1
+
+    return nremoved
 
 
 def writeStream(stream, items):
@@ -160,6 +1322,48 @@ def write(stream_or_path, items):
     return writeStream(stream_or_path, items)
 
 
+# Locking. Several processes may want to modify the same data file at once
+# (e.g., update-cites and update-github). Files are replaced by renaming, so
+# readers always see a complete file, but writers need to take turns. We
+# use an advisory lock on a hidden sidecar file, since the data file itself
+# gets replaced. Without fcntl (i.e., on Windows) there's no locking.
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def _lockPath(path):
+    head, tail = os.path.split(path)
+    return os.path.join(head, '.' + tail + '.lock')
+
+
+@contextlib.contextmanager
+def _lockFile(path):
+    """Hold an exclusive lock on the data file at `path`, blocking until any
+    other process holding it lets go."""
+
+    if fcntl is None:
+        yield
+        return
+
+    with io.open(_lockPath(path), 'ab') as lockfile:
+        fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_UN)
+
+
+def _statKey(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _noop():
+    pass
+
+
 # Parsing plus inline modification, preserving the file
 # as much as possible.
 #
@@ -167,39 +1371,115 @@ def write(stream_or_path, items):
 # hasn't been thoroughly tested, and it's a little hairy ...
 
 class FileChunk(object):
+    """One record of a file being mutated, along with the lines it came from.
+    `data` holds the parsed fields, plus the record's `_fingerprint`, the
+    same one that readStream() would give it. Changes made with set() or
+    set_many() are reflected in the lines that emit() writes out; `dirty`
+    records whether any of them actually changed a value."""
+
     def __init__(self):
         self.data = Holder()
+        self.dirty = False
+        self._changes = {}
         self._lines = []
+        self._keylines = {}  # field name -> indices of its lines
+        self._head = 0  # where the section header is
+        self._tail = 0  # where new fields get inserted
 
 
     def _addLine(self, line, assoc):
         self._lines.append((assoc, line))
 
+        if assoc is not None:
+            self._keylines.setdefault(assoc, []).append(len(self._lines) - 1)
+            self._tail = len(self._lines)
 
-    def set(self, name, value):
+
+    def _addHeader(self, line):
+        self._head = len(self._lines)
+        self._lines.append((None, line))
+        self._tail = len(self._lines)
+
+
+    def _finish(self):
+        """Called once all of the chunk's lines have been read."""
+        text = ''.join(line for assoc, line in self._lines[self._head:])
+        self.data._fingerprint = _hashRecord(text)
+
+
+    def _replace(self, name, value):
+        """Update the lines of field `name` to hold `value`. If the field has
+        no lines, returns the line that needs to be added for it; otherwise
+        returns None. If the field already has this value, the chunk is left
+        untouched, even if the value is wrapped or quoted differently than
+        set() would write it."""
+
+        value = u'%s' % value
+
+        if name in self._keylines and self.data.get(name) == value:
+            return None
+
+        self.data.setone(name, value)
+        self.dirty = True
+        self._changes[name] = value
         newline = (u'%s = %s' % (name, value)) + os.linesep
-        first = True
+        indices = self._keylines.get(name)
 
-        for i in range(len(self._lines)):
-            assoc, line = self._lines[i]
+        if not indices:
+            return newline
 
-            if assoc != name:
-                continue
+        self._lines[indices[0]] = (name, newline)
 
-            if first:
-                self._lines[i] = (assoc, newline)
-                first = False
-            else:
-                # delete the line
-                self._lines[i] = (None, None)
+        for i in indices[1:]:
+            # delete the line
+            self._lines[i] = (None, None)
 
-        if first:
-            # Need to append the line to the last block
-            for i in range(len(self._lines) - 1, -1, -1):
-                if self._lines[i][0] is not None:
-                    break
+        del indices[1:]
+        return None
+
+
+    def _insert(self, newlines):
+        # Every line associated with a field comes before _tail, so inserting
+        # there doesn't invalidate any of the indices in _keylines.
+        pos = self._tail
+        self._lines[pos:pos] = newlines
+
+        for i, (name, line) in enumerate(newlines):
+            self._keylines[name] = [pos + i]
+
+        self._tail = pos + len(newlines)
+
+
+    def set(self, name, value):
+        newline = self._replace(name, value)
+        if newline is not None:
+            self._insert([(name, newline)])
 
-            self._lines.insert(i + 1,(name, newline))
+
+    def set_many(self, fields):
+        """Set several fields at once. `fields` is a dict or an iterable of
+        ``(name, value)`` pairs; fields that need new lines are added in that
+        order."""
+
+        if hasattr(fields, 'items'):
+            fields = fields.items()
+
+        newlines = {}
+
+        for name, value in fields:
+            if name in newlines:
+                # Already being added; the later value wins.
+                self.data.setone(name, u'%s' % value)
+                self._changes[name] = u'%s' % value
+                newlines[name] = (u'%s = %s' % (name, value)) + os.linesep
+                continue
+
+            newline = self._replace(name, value)
+            if newline is not None:
+                newlines[name] = newline
+
+        if len(newlines):
+            self._insert(list(newlines.items()))
 
 
     def emit(self, stream):
@@ -226,6 +1506,7 @@ def mutateStream(instream, outstream):
                 if key is not None:
                     chunk.data.setone(key, data.strip())
                     key = data = None
+                chunk._finish()
                 yield chunk
                 chunk.emit(outstream)
 
@@ -234,7 +1515,7 @@ def mutateStream(instream, outstream):
                 chunk._addLine(miscline, None)
             misclines = []
             chunk.data.section = m.group(1)
-            chunk._addLine(fullline, None)
+            chunk._addHeader(fullline)
             continue
 
         if len(line.strip()) == 0:
@@ -283,6 +1564,7 @@ def mutateStream(instream, outstream):
     if chunk is not None:
         if key is not None:
             chunk.data.setone(key, data.strip())
+        chunk._finish()
         yield chunk
         chunk.emit(outstream)
 
@@ -301,17 +1583,107 @@ def mutate(instream_or_path, outstream_or_path, outmode='w'):
     return mutateStream(instream_or_path, outstream_or_path)
 
 
-def mutateInPlace(inpath):
+def _changeKey(chunk, keyfield):
+    """Identify a record for _replayChanges: by its value of `keyfield`, if
+    it has one, and otherwise by its fingerprint."""
+
+    if keyfield is not None:
+        value = chunk.data.get(keyfield)
+        if value is not None:
+            return (chunk.data.section, keyfield, value)
+
+    return (chunk.data.section, None, chunk.data._fingerprint)
+
+
+def _replayChanges(inpath, tmppath, changes, keyfield):
+    """Redo the changes recorded from a mutation of an older version of the
+    file at `inpath`, writing the result to `tmppath`. `changes` maps the
+    _changeKey() of each record that was changed to the fields that were set
+    in it; a list of them, in file order, if several records share the key.
+
+    The whole of the new version is written out, including records that
+    were added to it. If any of the changed records can't be found in it,
+    an exception is raised. Returns whether any record was modified."""
+
+    pending = dict((key, list(fieldlists)) for key, fieldlists in changes.items())
+    dirty = False
+
+    with _openText(inpath) as instream:
+        with _openText(tmppath, 'wt', like=inpath) as outstream:
+            for chunk in mutateStream(instream, outstream):
+                fieldlists = pending.get(_changeKey(chunk, keyfield))
+                if not fieldlists:
+                    continue
+
+                chunk.set_many(fieldlists.pop(0))
+                dirty = dirty or chunk.dirty
+
+    if any(len(fieldlists) for fieldlists in pending.values()):
+        raise Exception('cannot merge changes into "%s": records that were '
+                        'changed have been modified or removed by someone '
+                        'else' % inpath)
+
+    return dirty
+
+
+def mutateInPlace(inpath, txn=None, keyfield=None):
+    """Mutate the file at `inpath`. If none of its chunks end up dirty, the
+    original file is left alone, so its mtime doesn't change.
+
+    The file isn't locked while the caller works through its chunks, which
+    might take a while. If another process has replaced the file in the
+    meantime, the fields set here are merged into the new version, so that
+    neither process's changes are lost. (Where both set the same field, ours
+    win.) Records that the other process added are kept. The records that
+    were changed here are found again by their value of the field
+    `keyfield`, if it's given and they have one, and otherwise by their
+    content, so without a key they can only be found if the other process
+    left them alone. If any can't be found, an exception is raised and the
+    file is left as the other process wrote it.
+
+    If `txn` is a Transaction, the new version of the file is staged in it
+    rather than replacing the file right away.
+
+    Compressed files are decompressed as they're read and the new version is
+    compressed the same way."""
+
     from sys import exc_info
     from os import rename, unlink
 
-    tmppath = inpath + '.new'
+    tmppath = _stagedPath(inpath)
+    dirty = False
+    changes = {}
+
+    with _openText(inpath) as instream:
+        opened = _statKey(os.fstat(instream.fileno()))
 
-    with io.open(inpath, 'rt') as instream:
         try:
-            with io.open(tmppath, 'wt') as outstream:
+            with _openText(tmppath, 'wt', like=inpath) as outstream:
                 for item in mutateStream(instream, outstream):
+                    key = _changeKey(item, keyfield)  # before the caller changes it
                     yield item
+                    if item.dirty:
+                        dirty = True
+                        changes.setdefault(key, []).append(item._changes)
+
+            if not dirty:
+                unlink(tmppath)
+                return
+
+            if txn is not None:
+                def redo():
+                    if _replayChanges(inpath, tmppath, changes, keyfield):
+                        return _noop
+                    return None
+
+                txn._stage(inpath, tmppath, opened, redo, _noop)
+                return
+
+            with _lockFile(inpath):
+                if _statKey(os.stat(inpath)) != opened:
+                    if not _replayChanges(inpath, tmppath, changes, keyfield):
+                        unlink(tmppath)
+                        return
                 rename(tmppath, inpath)
         except:
             et, ev, etb = exc_info()
@@ -320,3 +1692,538 @@ def mutateInPlace(inpath):
             except Exception:
                 pass
             raise et(ev).with_traceback(etb)
+
+
+# Indexed patching. Rather than streaming a whole file through
+# mutateStream, we can find the byte range of each record by a quick header
+# scan, remember those ranges, and then only parse and rewrite the records
+# that actually change, splicing them into the rest of the file.
+
+def indexRecords(path, keyfield, cachedir=None):
+    """Map the records in the data file at `path` to their byte ranges.
+    Returns a dict mapping ``(section, value)``, where `value` is a record's
+    value of the field `keyfield`, to a list of ``(start, end)`` byte ranges.
+    Records without that field aren't indexed. Each range runs from a
+    record's header line to the next record's header, or the end of the
+    file.
+
+    If `cachedir` is given, the index is saved there and reused as long as
+    the file's size and mtime are unchanged."""
+
+    if _compression(path) is not None:
+        raise Exception('cannot index compressed file "%s"' % path)
+
+    import pickle
+
+    st = os.stat(path)
+    cpath = None
+
+    if cachedir is not None:
+        cpath = _cachePath(cachedir, path, 'index-' + keyfield)
+        try:
+            with io.open(cpath, 'rb') as cf:
+                header = pickle.load(cf)
+                if (header.get('version') == _cacheVersion and
+                        header['mtime'] == st.st_mtime_ns and
+                        header['size'] == st.st_size):
+                    return pickle.load(cf)
+        except Exception:
+            pass
+
+    index = {}
+    buf = _mapFile(path)
+
+    if buf is not None:
+        for section, start, body, end in _recordRanges(buf):
+            value = MappedHolder(buf, section, body, end).get(keyfield)
+            if value is not None:
+                index.setdefault((section, value), []).append((start, end))
+
+    if cpath is not None:
+        _writeCache(cpath, {'version': _cacheVersion, 'mtime': _trustedMtime(st),
+                            'size': st.st_size}, index)
+
+    return index
+
+
+class _StaleIndex(Exception):
+    pass
+
+
+def _patchRecord(text, keyfield, key, fields):
+    """Apply `fields` to the single record in `text`, checking that it really
+    is the record identified by `key`. Returns None if nothing changed."""
+
+    if not text.endswith('\n'):
+        text += os.linesep  # otherwise an appended field would run on
+
+    out = io.StringIO()
+    dirty = False
+
+    for chunk in mutateStream(io.StringIO(text), out):
+        if (chunk.data.section, chunk.data.get(keyfield)) != key:
+            raise _StaleIndex()
+
+        chunk.set_many(fields)
+        dirty = dirty or chunk.dirty
+
+    if not dirty:
+        return None
+    return out.getvalue()
+
+
+def patchRecords(path, keyfield, changes, cachedir=None, txn=None):
+    """Modify records of the data file at `path` in place. `changes` maps keys
+    of the index returned by indexRecords(path, keyfield, cachedir) to dicts
+    of field values to set in the matching records. Keys that aren't found
+    are ignored.
+
+    Only the affected records are parsed and rewritten, just as mutateStream
+    would, preserving their comments and formatting. They're spliced into
+    the unchanged bytes of the rest of the file, and the result replaces the
+    original atomically. Records whose fields already have the requested
+    values don't count as modified, and if there are none, the file isn't
+    rewritten at all. Returns the number of records modified.
+
+    The file is locked against other writers while this happens. Since the
+    affected records are read afresh under the lock, changes that other
+    processes have made in the meantime are kept.
+
+    Compressed files can't be indexed, so they're streamed through
+    mutateStream in full instead.
+
+    If `txn` is a Transaction, the new version of the file is staged in it
+    rather than replacing the file right away; the count of records that
+    will be modified is returned."""
+
+    if not len(changes):
+        return 0  # don't bother indexing the file
+
+    tmppath = _stagedPath(path)
+
+    if txn is not None:
+        opened, count, after = _stagePatch(path, tmppath, keyfield, changes, cachedir)
+
+        if count:
+            def redo():
+                opened, count, after = _stagePatch(path, tmppath, keyfield, changes,
+                                                   cachedir)
+                return after if count else None
+
+            txn._stage(path, tmppath, opened, redo, after)
+
+        return count
+
+    with _lockFile(path):
+        opened, count, after = _stagePatch(path, tmppath, keyfield, changes, cachedir)
+
+        if count:
+            try:
+                os.rename(tmppath, path)
+            except:
+                try:
+                    os.unlink(tmppath)
+                except Exception:
+                    pass
+                raise
+
+            after()
+
+        return count
+
+
+def _stagePatch(path, tmppath, keyfield, changes, cachedir):
+    """Write a patched version of the file at `path` to `tmppath`. Returns the
+    stat key of the file that was read, the number of records modified, and
+    a function to call once the new version has replaced the original. If no
+    records are modified, nothing is written."""
+
+    # Stat before reading anything, so if the file gets replaced while we're
+    # at it, a later comparison will notice.
+    opened = _statKey(os.stat(path))
+
+    if _compression(path) is not None:
+        return opened, _streamPatch(path, tmppath, keyfield, changes), _noop
+
+    for attempt in range(2):
+        index = indexRecords(path, keyfield, cachedir if attempt == 0 else None)
+        edits = []
+
+        for key, fields in changes.items():
+            for start, end in index.get(key, ()):
+                edits.append((start, end, key, fields))
+
+        if not len(edits):
+            return opened, 0, None
+
+        edits.sort(key=lambda e: e[0])
+        buf = _mapFile(path)
+        changed = []
+        patched = []
+
+        try:
+            for edit in edits:
+                start, end, key, fields = edit
+                if buf[start:start + 1] != b'[':
+                    raise _StaleIndex()
+                if end != len(buf) and buf[end - 1:end + 1] != b'\n[':
+                    raise _StaleIndex()
+                text = _patchRecord(buf[start:end].decode('utf-8'), keyfield, key, fields)
+                if text is not None:
+                    changed.append(edit)
+                    patched.append(text.encode('utf-8'))
+        except _StaleIndex:
+            buf.close()
+            continue  # the file changed under the index; rebuild it and retry
+
+        if not len(changed):
+            buf.close()
+            return opened, 0, None  # don't touch the file if nothing really changed
+
+        edits = changed
+
+        try:
+            with io.open(tmppath, 'wb') as out:
+                pos = 0
+                for (start, end, key, fields), data in zip(edits, patched):
+                    out.write(buf[pos:start])
+                    out.write(data)
+                    pos = end
+                out.write(buf[pos:])
+        except:
+            try:
+                os.unlink(tmppath)
+            except Exception:
+                pass
+            raise
+        finally:
+            buf.close()
+
+        if cachedir is None:
+            return opened, len(edits), _noop
+        return opened, len(edits), lambda: _shiftIndex(path, keyfield, cachedir,
+                                                       index, edits, patched)
+
+    raise Exception('cannot index "%s": records keep changing' % path)
+
+
+def _streamPatch(path, tmppath, keyfield, changes):
+    """The equivalent of _stagePatch for compressed files, where byte offsets
+    are no use: the whole file is streamed through mutateStream."""
+
+    count = 0
+
+    try:
+        with _openText(path) as instream:
+            with _openText(tmppath, 'wt', like=path) as outstream:
+                for chunk in mutateStream(instream, outstream):
+                    fields = changes.get((chunk.data.section, chunk.data.get(keyfield)))
+                    if fields is not None:
+                        chunk.set_many(fields)
+                        count += chunk.dirty
+    except:
+        try:
+            os.unlink(tmppath)
+        except Exception:
+            pass
+        raise
+
+    if not count:
+        os.unlink(tmppath)
+    return count
+
+
+def _shiftIndex(path, keyfield, cachedir, index, edits, patched):
+    """Update a saved index after patchRecords has rewritten its file, so that
+    the next patch doesn't need to rescan it."""
+
+    from bisect import bisect_right
+
+    starts = [e[0] for e in edits]
+    shifts = [0]
+    newlens = {}
+
+    for (start, end, key, fields), data in zip(edits, patched):
+        shifts.append(shifts[-1] + len(data) - (end - start))
+        newlens[start] = len(data)
+
+    newindex = {}
+
+    for key, ranges in index.items():
+        newranges = []
+        for start, end in ranges:
+            newstart = start + shifts[bisect_right(starts, start - 1)]
+            newranges.append((newstart, newstart + newlens.get(start, end - start)))
+        newindex[key] = newranges
+
+    st = os.stat(path)
+    _writeCache(_cachePath(cachedir, path, 'index-' + keyfield),
+                {'version': _cacheVersion, 'mtime': _trustedMtime(st),
+                 'size': st.st_size}, newindex)
+
+
+# Transactions. A command that rewrites several files can stage all of the
+# new versions in a Transaction and then commit them together: the staged
+# files are synced, a journal listing them is written, and then they're
+# renamed into place. If we crash before the journal is complete, nothing
+# has changed; if we crash after, the next Transaction created in the same
+# directory finishes the renames. Either way the files never end up
+# half-updated.
+#
+# Data directories may be shared between hosts, so staged files and
+# journals are named after the host as well as the process that wrote them.
+# Only the processes of this host can be checked for liveness; the leftovers
+# of other hosts are left for those hosts to clean up.
+
+_journalPrefix = '.wljournal.'
+
+
+def _fsyncPath(path):
+    if os.name == 'nt' and os.path.isdir(path):
+        return  # can't open directories there; renames are durable anyway
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _pidAlive(pid):
+    if pid == os.getpid():
+        return True
+    if os.name == 'nt':
+        return True  # os.kill() would terminate it; assume the worst
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _hostName():
+    # Without dots, so that it can be split off a file name again.
+    import socket
+    return socket.gethostname().replace('.', '-') or 'localhost'
+
+
+def _ownerAlive(host, pid):
+    """Whether the process `pid` on `host` might still be running."""
+    if host != _hostName():
+        return True  # no way to tell
+    return _pidAlive(pid)
+
+
+def _stagedPath(path):
+    return '%s.%s.%d.new' % (path, _hostName(), os.getpid())
+
+
+class _Staged(object):
+    __slots__ = ('tmppath', 'opened', 'redo', 'after')
+
+    def __init__(self, tmppath, opened, redo, after):
+        self.tmppath = tmppath
+        self.opened = opened
+        self.redo = redo
+        self.after = after
+
+
+class Transaction(object):
+    """A set of file rewrites that are committed or rolled back together.
+    Pass one as the `txn` argument of mutateInPlace or patchRecords to stage
+    their results, then call commit() or rollback(). Used as a context
+    manager, it commits if the block exits normally and rolls back if it
+    raises.
+
+    The journal goes in `journaldir`, which should be on the same
+    filesystem as the files being modified (typically it's the data
+    directory). Creating a Transaction first recovers any transactions that
+    were interrupted there."""
+
+    def __init__(self, journaldir):
+        self.journaldir = journaldir
+        self._staged = {}
+        recoverTransactions(journaldir)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, etype, evalue, etb):
+        if etype is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+    def _stage(self, path, tmppath, opened, redo, after):
+        """Stage `tmppath` as the new version of `path`. `opened` is the stat
+        key of the version of `path` it was derived from. If the file has
+        changed by commit time, `redo` is called to rederive `tmppath`; it
+        returns a new `after`, or None if there's no longer anything to
+        commit. `after` is called once the new version is in place."""
+
+        path = os.path.abspath(path)
+        if path in self._staged:
+            raise Exception('"%s" is already staged in this transaction' % path)
+
+        self._staged[path] = _Staged(os.path.abspath(tmppath), opened, redo, after)
+
+
+    def rollback(self):
+        for staged in self._staged.values():
+            try:
+                os.unlink(staged.tmppath)
+            except OSError:
+                pass
+
+        self._staged = {}
+
+
+    def commit(self):
+        """Replace all of the staged files, atomically as far as anyone
+        reading them is concerned, and durably once this returns."""
+
+        import json
+
+        if not len(self._staged):
+            return
+
+        paths = sorted(self._staged)
+        committed = False
+
+        try:
+            with contextlib.ExitStack() as locks:
+                for path in paths:
+                    locks.enter_context(_lockFile(path))
+
+                # Merge in changes made since the files were staged.
+                for path in paths[:]:
+                    staged = self._staged[path]
+                    if _statKey(os.stat(path)) == staged.opened:
+                        continue
+
+                    staged.after = staged.redo()
+                    staged.opened = _statKey(os.stat(path))
+                    if staged.after is None:
+                        # The redo may have removed it already.
+                        try:
+                            os.unlink(staged.tmppath)
+                        except OSError:
+                            pass
+                        del self._staged[path]
+                        paths.remove(path)
+
+                if not len(paths):
+                    return
+
+                for path in paths:
+                    _fsyncPath(self._staged[path].tmppath)
+
+                # The commit point is the rename of the complete journal.
+                jpath = os.path.join(self.journaldir, '%s%s.%d' % (
+                    _journalPrefix, _hostName(), os.getpid()))
+                entries = [(self._staged[p].tmppath, p, self._staged[p].opened)
+                           for p in paths]
+
+                with io.open(jpath + '.tmp', 'wt') as f:
+                    json.dump(entries, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                os.rename(jpath + '.tmp', jpath)
+                committed = True
+                _fsyncPath(self.journaldir)
+
+                for path in paths:
+                    os.rename(self._staged[path].tmppath, path)
+
+                for dirpath in sorted(set(os.path.dirname(p) for p in paths)):
+                    _fsyncPath(dirpath)
+
+                os.unlink(jpath)
+
+                for path in paths:
+                    self._staged[path].after()
+        except:
+            if committed:
+                self._staged = {}  # the journal is there; recovery will finish up
+            else:
+                self.rollback()
+            raise
+
+        self._staged = {}
+
+
+def recoverTransactions(journaldir):
+    """Clean up after transactions that were interrupted by a crash. Committed
+    ones are completed, as far as possible: if a file was modified again
+    since the crash, its staged version is discarded rather than replacing
+    the newer one. Uncommitted ones are rolled back. Staged files in
+    `journaldir` are removed if they belong to a data file that's there.
+    Only the leftovers of processes of this host that are no longer running
+    are touched. Returns the number of transactions completed."""
+
+    import json
+
+    ncompleted = 0
+    names = set(os.listdir(journaldir))
+
+    # Journals are named ".wljournal.<host>.<pid>", plus ".tmp" until they're
+    # complete.
+    for name in sorted(names):
+        if not name.startswith(_journalPrefix):
+            continue
+
+        pieces = name[len(_journalPrefix):].split('.')
+        if len(pieces) not in (2, 3) or not pieces[1].isdigit():
+            continue
+        if _ownerAlive(pieces[0], int(pieces[1])):
+            continue
+
+        jpath = os.path.join(journaldir, name)
+
+        if len(pieces) == 3:
+            if pieces[2] == 'tmp':
+                os.unlink(jpath)  # never reached its commit point
+            continue
+
+        with io.open(jpath, 'rt') as f:
+            entries = json.load(f)
+
+        for tmppath, path, opened in entries:
+            if not os.path.exists(tmppath):
+                continue  # already renamed
+
+            with _lockFile(path):
+                if os.path.exists(path) and _statKey(os.stat(path)) == tuple(opened):
+                    os.rename(tmppath, path)
+                    _fsyncPath(os.path.dirname(path))
+                else:
+                    os.unlink(tmppath)
+
+        os.unlink(jpath)
+        ncompleted += 1
+
+    # Staged files are named "<file>.<host>.<pid>.new".
+    for name in sorted(names):
+        if not name.endswith('.new'):
+            continue
+
+        pieces = name[:-4].rsplit('.', 2)
+        if len(pieces) != 3 or not pieces[2].isdigit() or pieces[0] not in names:
+            continue
+        if _ownerAlive(pieces[1], int(pieces[2])):
+            continue
+
+        try:
+            os.unlink(os.path.join(journaldir, name))
+        except OSError:
+            pass  # already handled above
+
+    return ncompleted
@@ -7,8 +7,9 @@ Shared routines for my worklog tools.
 """
 
 from __future__ import absolute_import, division, print_function
+from functools import lru_cache
 from six import string_types, text_type
-from six.moves import map, range, zip
+from six.moves import range, zip
 
 __all__ = str(
     """
@@ -20,8 +21,26 @@ warn
 open_template
 slurp_template
 process_template
+CompiledTemplate
 list_data_files
+DATA_RECURSIVE
+DATA_INCLUDE
+DATA_EXCLUDE
+LOAD_JOBS
+LOAD_ORDER
 load
+date_interval
+field_schemas
+typed_value
+export_columns
+export_records
+count_sections
+cache_dir
+clean_cache
+update_index
+open_index
+RecordIndex
+DataWatcher
 unicode_to_latex
 html_escape
 Markup
@@ -107,73 +126,1320 @@ class MultilineHandler(object):
 
 
 def process_template(stream, commands, context):
-    """Read through a template line-by-line and replace special lines. Each
-    regular line is yielded to the caller. `commands` is a dictionary of
-    strings to callables; if the first word in a line is in `commands`, the
-    callable is invoked, with `context` and the remaining words in the line as
-    arguments. Its return value is either a string or an iterable, with each
-    iterate being yielded to the caller in the latter case."""
+    """Read through a template line-by-line and replace special lines. Regular
+    lines are yielded to the caller, several at a time joined by newlines.
+    `commands` is a dictionary of strings to callables; if the first word in a
+    line is in `commands`, the callable is invoked, with `context` and the
+    remaining words in the line as arguments. Its return value is either a
+    string or an iterable, with each iterate being yielded to the caller in
+    the latter case, or a MultilineHandler, which is given the following
+    lines up to one reading "END" and then returns the same sort of value.
 
-    current_multiline_handler = None
+    The template is compiled into a sequence of operations the first time it
+    is seen, so rendering it again (e.g., in `wltool watch`) doesn't involve
+    parsing it again."""
 
-    for line in stream:
-        line = line.decode("utf8").rstrip()
+    template = _compile_template(tuple(stream), frozenset(commands))
 
-        if current_multiline_handler is not None:
-            if line != "END":
-                current_multiline_handler.handle_line(context, line)
-            else:
-                result = current_multiline_handler.handle_end_span(context)
-                if isinstance(result, string_types):
-                    yield result
-                else:
-                    for subline in result:
-                        yield subline
-                current_multiline_handler = None
+    for text in template.run(commands, context):
+        yield text
+
+
+def _yield_result(result):
+    if isinstance(result, string_types):
+        yield result
+    else:
+        for subline in result:
+            yield subline
+
+
+class CompiledTemplate(object):
+    """A template as compiled by _compile_template(). `ops` is a list of
+    operations, each of which is either `(text,)`, for a run of regular
+    lines, or `(name, args, span, resume)`, for a line invoking the command
+    `name`. If the command returns a MultilineHandler, `span` holds the
+    lines that it should be given, and `resume` is the index of the
+    operation after the span's END, or None if the span runs to the end of
+    the template."""
+
+    def __init__(self, ops):
+        self.ops = ops
+
+    def run(self, commands, context):
+        ops = self.ops
+        nops = len(ops)
+        i = 0
+
+        while i < nops:
+            op = ops[i]
+            i += 1
+
+            if len(op) == 1:
+                yield op[0]
+                continue
+
+            name, args, span, resume = op
+            result = commands[name](context, *args)
+
+            if isinstance(result, MultilineHandler):
+                for line in span:
+                    result.handle_line(context, line)
+
+                if resume is None:
+                    return
+
+                result = result.handle_end_span(context)
+                i = resume
+
+            for text in _yield_result(result):
+                yield text
+
+
+@lru_cache(maxsize=32)
+def _compile_template(lines, names):
+    """Compile a template, given as a tuple of lines of UTF-8, for the
+    commands `names`. Calls are cached, keyed by the template contents, so
+    each template is only compiled once per process."""
+
+    lines = [line.decode("utf8").rstrip() for line in lines]
+    words = [line.split() for line in lines]
+    ends = [i for i, line in enumerate(lines) if line == "END"]
+
+    # Lines that can begin a run of regular lines. Any line after an END
+    # could be where a span finishes, so runs get broken up there.
+    starts = set(i + 1 for i in ends)
+    ops = []
+    calls = []
+    opindex = {}
+    text = None
+
+    for i, a in enumerate(words):
+        if len(a) and a[0] in names:
+            text = None
+            opindex[i] = len(ops)
+            calls.append((len(ops), i))
+            ops.append(None)  # filled in below
+        elif text is None or i in starts:
+            text = [lines[i]]
+            opindex[i] = len(ops)
+            ops.append(text)
         else:
-            a = line.split()
+            text.append(lines[i])
 
-            if not len(a) or a[0] not in commands:
-                yield line
-            else:
-                result = commands[a[0]](context, *a[1:])
-                if isinstance(result, string_types):
-                    yield result
-                elif isinstance(result, MultilineHandler):
-                    current_multiline_handler = result
-                else:
-                    for subline in result:
-                        yield subline
+    ops = [op if op is None else ("\n".join(op),) for op in ops]
 
+    for n, i in calls:
+        end = next((j for j in ends if j > i), None)
 
-def list_data_files(datadir="."):
-    from os import listdir
-    from os.path import join
+        if end is None:
+            span, resume = tuple(lines[i + 1 :]), None
+        else:
+            span, resume = tuple(lines[i + 1 : end]), opindex.get(end + 1, len(ops))
+
+        ops[n] = (words[i][0], tuple(words[i][1:]), span, resume)
+
+    return CompiledTemplate(ops)
+
+
+# Data files may be compressed; inifile takes care of that.
+_data_suffixes = (".txt", ".txt.gz", ".txt.bz2", ".txt.xz")
 
+
+def list_data_files(datadir=".", recursive=None, include=None, exclude=None):
+    """Yield the paths of the data files in `datadir`, which may also be a
+    list of directories, searched in turn.
+
+    If `recursive`, subdirectories are searched too, and their contents
+    are listed in order along with the files, as if the paths were sorted
+    component by component. So that large trees don't have to be walked
+    every time, the listing of each directory is saved in the cache
+    directory of each root and reused as long as the directory's mtime is
+    unchanged.
+
+    `include` and `exclude` are lists of glob patterns matched against the
+    paths of files relative to their roots, with "/" as the separator; note
+    that "*" matches across separators. If `include` is given, only files
+    matching one of its patterns are listed. Files matching one of the
+    `exclude` patterns aren't listed, and neither are the contents of
+    directories matching one. The defaults for these three come from
+    `DATA_RECURSIVE`, `DATA_INCLUDE`, and `DATA_EXCLUDE`."""
+    if recursive is None:
+        recursive = DATA_RECURSIVE
+    if include is None:
+        include = DATA_INCLUDE
+    if exclude is None:
+        exclude = DATA_EXCLUDE
+
+    roots = [datadir] if isinstance(datadir, string_types) else list(datadir)
     any = False
 
-    for item in sorted(listdir(datadir)):
-        if item.startswith("."):
+    for root in roots:
+        tree = _DirectoryTree(root) if recursive else None
+
+        for path in _walk_data_dir(root, "", tree, include, exclude):
+            # Note that if there are text files that contain no records (e.g.
+            # all commented), we won't complain.
+            any = True
+            yield path
+
+        if tree is not None:
+            tree.save()
+
+    if not any:
+        die('no data files found in directory "%s"', '", "'.join(roots))
+
+
+def _walk_data_dir(root, reldir, tree, include, exclude):
+    from fnmatch import fnmatchcase
+    from os.path import join
+
+    dirpath = join(root, reldir) if len(reldir) else root
+
+    if tree is None:
+        files = _scan_data_dir(dirpath)[0]
+        subdirs = []
+    else:
+        files, subdirs = tree.listing(dirpath, reldir)
+
+    subdirs = set(subdirs)
+
+    for name in sorted(files + list(subdirs)):
+        relpath = reldir + "/" + name if len(reldir) else name
+
+        if any(fnmatchcase(relpath, pat) for pat in exclude):
             continue
-        if not item.endswith(".txt"):
+
+        if name in subdirs:
+            for path in _walk_data_dir(root, relpath, tree, include, exclude):
+                yield path
+        elif not len(include) or any(fnmatchcase(relpath, p) for p in include):
+            yield join(dirpath, name)
+
+
+def _scan_data_dir(dirpath):
+    """List a directory, returning the names of the data files and the
+    subdirectories in it."""
+    import os
+
+    files = []
+    subdirs = []
+
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            name = entry.name
+
+            if name.startswith("."):
+                continue
+            elif entry.is_dir(follow_symlinks=False):
+                subdirs.append(name)
+            elif name.endswith(_data_suffixes):
+                files.append(name)
+
+    return files, subdirs
+
+
+class _DirectoryTree(object):
+    """The saved directory listings used by list_data_files() when searching
+    recursively."""
+
+    version = 2
+
+    def __init__(self, root):
+        import pickle
+        from os.path import join
+
+        self.path = join(cache_dir(root), ".tree")
+        self.old = {}
+        self.new = {}
+
+        try:
+            with open(self.path, "rb") as f:
+                if pickle.load(f).get("version") == self.version:
+                    self.old = pickle.load(f)
+        except Exception:
+            pass
+
+    def listing(self, dirpath, reldir):
+        import os
+        from inifile import _trustedMtime
+
+        st = os.stat(dirpath)
+        saved = self.old.get(reldir)
+
+        if saved is not None and saved[0] == st.st_mtime_ns:
+            self.new[reldir] = saved
+            return saved[1], saved[2]
+
+        files, subdirs = _scan_data_dir(dirpath)
+        self.new[reldir] = (_trustedMtime(st), files, subdirs)
+        return files, subdirs
+
+    def save(self):
+        from inifile import _writeCache
+
+        if self.new != self.old:
+            _writeCache(self.path, {"version": self.version}, self.new)
+
+
+# Where list_data_files() looks for data files by default; wltool sets these
+# from its -r, --include, and --exclude options.
+DATA_RECURSIVE = False
+DATA_INCLUDE = ()
+DATA_EXCLUDE = ()
+
+# The number of processes that load() uses to parse data files by default;
+# see load(). wltool sets this from its -j option.
+LOAD_JOBS = 1
+
+# The `order` that setup_processing() passes to load(), so that templates see
+# the records in date order; wltool sets this from its --by-date option.
+LOAD_ORDER = None
+
+# With fewer data files than this, it's not worth starting up worker
+# processes.
+_parallel_min_files = 8
+
+
+def _read_data_file(path, lazy, mapped, compact, cache, sections, where):
+    from os.path import dirname
+    from inifile import read as iniread, readCached, readMapped
+
+    if mapped:
+        return readMapped(path, sections=sections, where=where)
+    if cache and not lazy:
+        return readCached(
+            path,
+            cache_dir(dirname(path)),
+            compact=compact,
+            sections=sections,
+            where=where,
+        )
+    return iniread(path, lazy=lazy, compact=compact, sections=sections, where=where)
+
+
+def _read_data_file_list(args):
+    # This runs in worker processes.
+    return list(_read_data_file(*args))
+
+
+def load(
+    datadir=".",
+    lazy=False,
+    mapped=False,
+    compact=False,
+    cache=False,
+    typed=False,
+    jobs=None,
+    sections=None,
+    where=None,
+    window=None,
+    order=None,
+):
+    """Yield all of the records in the data files in `datadir`.
+
+    If `lazy`, records only parse their fields when a field other than
+    `section` is first accessed, so callers that only want certain sections
+    don't pay to tokenize the rest. If `mapped`, the files are additionally
+    memory-mapped and each field value is only decoded when it's accessed.
+    If `compact`, records are CompactHolders, which take much less memory
+    when many of them are kept around. If `cache` (and not `lazy` or
+    `mapped`), parsed records are cached on disk next to the data files, so
+    that unchanged files don't need to be reparsed next time.
+
+    Data files may be compressed, with names ending in `.txt.gz`,
+    `.txt.bz2`, or `.txt.xz`. They're decompressed as they're read; since
+    they can't be memory-mapped, `mapped` is treated as `lazy` for them.
+
+    If `typed`, the fields listed in `field_schemas` are decoded as the
+    records are loaded; see `typed_value()`. Values that can't be decoded
+    are reported, with their locations, just this once.
+
+    If `jobs` is more than 1, the files are parsed in that many worker
+    processes (or one per CPU if it's 0), though the records are still
+    yielded in the same order. The default comes from `LOAD_JOBS`. Lazy and
+    mapped records can't be passed between processes, and with only a few
+    files it isn't worthwhile, so in those cases the files are just read
+    one by one.
+
+    If `sections` is given, as a section name or a collection of them, only
+    records in those sections are loaded; records in other sections aren't
+    even parsed. `where` is a dict mapping field names to either a value,
+    which the field must equal, or a function that takes the field's value
+    and returns whether the record is wanted; e.g., `{"refereed": "y"}`.
+    Records are checked against it before they're fully parsed, and those
+    without all of the fields in `where` are skipped.
+
+    `window` restricts the records to a range of dates. It's a tuple
+    `(field, start, end)`, where `field` is the name of the date field (e.g.
+    "pubdate") and `start` and `end` are `(year, month)` tuples, inclusive,
+    or None to leave that end open. Records are kept if their date overlaps
+    the window; see `date_interval()` for the formats understood.
+
+    When filtering by `sections` or `window`, files that can't have any
+    matching records aren't read at all. This uses a summary of each file's
+    sections and dates that's kept in its cache directory.
+
+    Normally records are yielded in the order of the files and then of the
+    records within each file. If `order` is given, as the name of a date
+    field or a sequence of them, records are instead yielded in order of
+    date, using the first of those fields that each record has. Each file's
+    records are sorted on their own and then the files are merged, so files
+    can be split up however is convenient. Records with equal dates, or
+    without any of the fields, keep their places relative to their
+    neighbors."""
+    import os
+
+    paths = list(list_data_files(datadir))
+
+    if window is not None:
+        field, start, end = window
+        where = dict(where or {})
+        where[field] = lambda text: _overlaps(date_interval(text), start, end)
+
+    if sections is not None or window is not None:
+        paths = _prune_data_files(paths, sections, window)
+
+    if jobs is None:
+        jobs = LOAD_JOBS
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    files = _load_data_files(
+        paths, lazy, mapped, compact, cache, typed, jobs, sections, where
+    )
+
+    if order is None:
+        for items in files:
+            for item in items:
+                yield item
+    else:
+        for item in _merge_by_date(files, order):
+            yield item
+
+
+def _load_data_files(
+    paths, lazy, mapped, compact, cache, typed, jobs, sections, where
+):
+    """Yield an iterable of the records of each of `paths`, in order; see
+    load()."""
+    if jobs > 1 and not (lazy or mapped) and len(paths) >= _parallel_min_files:
+        from concurrent.futures import ProcessPoolExecutor
+        from inifile import filterRecords
+
+        if where is not None and any(callable(w) for w in where.values()):
+            # Lambdas and such can't be sent to the workers, so filter here.
+            keep = where
+            where = None
+        else:
+            keep = None
+
+        args = [
+            (path, False, False, compact, cache, sections, where) for path in paths
+        ]
+
+        with ProcessPoolExecutor(min(jobs, len(paths))) as pool:
+            chunksize = max(1, len(paths) // (4 * jobs))
+            results = pool.map(_read_data_file_list, args, chunksize=chunksize)
+
+            for path, items in zip(paths, results):
+                if keep is not None:
+                    items = filterRecords(items, where=keep)
+                if typed:
+                    items = _decode_typed(path, items)
+                yield items
+        return
+
+    for path in paths:
+        items = _read_data_file(path, lazy, mapped, compact, cache, sections, where)
+
+        if typed:
+            items = _decode_typed(path, items)
+        yield items
+
+
+def _merge_by_date(files, order):
+    """Merge the records of several files, given as one iterable per file, in
+    date order; see load()."""
+    import heapq
+
+    if isinstance(order, string_types):
+        order = (order,)
+
+    keyed = [_order_by_date(items, order) for items in files]
+
+    for _, _, item in heapq.merge(*keyed, key=lambda t: t[0]):
+        yield item
+
+
+def _order_by_date(items, fields):
+    """Sort the records of one data file for load()'s `order` option,
+    returning a list of `(key, index, item)` tuples. The key is the first
+    month of the first of `fields` that the record has. Records without a
+    usable date take the key of the record before them, so that they stay
+    next to it."""
+    keyed = []
+    key = (0, 0)
+
+    for index, item in enumerate(items):
+        for field in fields:
+            text = item.get(field)
+            if text is None:
+                continue
+
+            interval = date_interval(text)
+            if interval is not None:
+                key = interval[0]
+            break
+
+        keyed.append((key, index, item))
+
+    keyed.sort(key=lambda t: t[:2])
+    return keyed
+
+
+# Pruning data files. For each file, we keep a summary of which sections its
+# records have and the range of dates that they span, so that filtered
+# loads can skip files without reading them.
+
+_date_fields = ("pubdate", "date")
+_month_numbers = dict((m.lower(), i + 1) for i, m in enumerate(months))
+
+
+def _date_bounds(text):
+    import re
+
+    text = text.strip().lower()
+    if text in ("present", "now", "current"):
+        return (9999, 1), (9999, 12)
+
+    m = re.match(r"(\d{4})(?:\s*[/ -]\s*(\d{1,2}|[a-z]{3}))?", text)
+    if m is None:
+        return None
+
+    year = int(m.group(1))
+    month = m.group(2)
+    if month is None:
+        return (year, 1), (year, 12)
+
+    if month.isdigit():
+        month = int(month)
+    else:
+        month = _month_numbers.get(month)
+    if month is None or month < 1 or month > 12:
+        return None
+    return (year, month), (year, month)
+
+
+def date_interval(text):
+    """Interpret the text of a date field as an inclusive range of months,
+    returning `((year1, month1), (year2, month2))`, or None if it can't be
+    understood. Understood formats include "2013", "2013/04", "2013/04/15",
+    "2013 Apr", and ranges of those such as "2010–2012" (with an en dash or
+    hyphen) or "2012–present"."""
+    import re
+
+    separator = r"\s*(?:–|—|--|-(?=\s*(?:\d{4}|present)))\s*"
+    pieces = re.split(separator, text.strip(), 1)
+    first = _date_bounds(pieces[0])
+    last = _date_bounds(pieces[-1])
+
+    if first is None or last is None:
+        return None
+    return first[0], last[1]
+
+
+def _overlaps(interval, start, end):
+    if interval is None:
+        return False
+    if start is not None and interval[1] < start:
+        return False
+    if end is not None and interval[0] > end:
+        return False
+    return True
+
+
+def _summarize_data_file(path):
+    """Compute the summary of a data file used by _prune_data_files: a
+    `(sections, dates)` tuple, where `sections` is the set of its sections
+    and `dates` maps each date field that appears to the earliest and latest
+    month of all of its values, or to None if any couldn't be understood."""
+    from inifile import readMapped
+
+    sections = set()
+    dates = {}
+
+    for item in readMapped(path):
+        sections.add(item.section)
+
+        for field in _date_fields:
+            text = item.get(field)
+            if text is None:
+                continue
+
+            interval = date_interval(text)
+            if interval is None or field in dates and dates[field] is None:
+                dates[field] = None
+            elif field not in dates:
+                dates[field] = interval
+            else:
+                lo, hi = dates[field]
+                dates[field] = (min(lo, interval[0]), max(hi, interval[1]))
+
+    return sections, dates
+
+
+def _prune_data_files(paths, sections, window):
+    from os.path import dirname
+    from inifile import cachedInfo
+
+    if isinstance(sections, string_types):
+        sections = (sections,)
+
+    kept = []
+
+    for path in paths:
+        filesects, dates = cachedInfo(
+            path, cache_dir(dirname(path)), "summary", _summarize_data_file
+        )
+
+        if sections is not None and filesects.isdisjoint(sections):
             continue
 
-        # Note that if there are text files that contain no records (e.g. all
-        # commented), we won't complain.
-        any = True
-        yield join(datadir, item)
+        if window is not None and window[0] in _date_fields:
+            field, start, end = window
+            if field not in dates:
+                continue  # no records with that field at all
+            if dates[field] is not None and not _overlaps(dates[field], start, end):
+                continue
+
+        kept.append(path)
+
+    return kept
+
+
+# Typed fields. Some fields hold numbers or dates that get used all over the
+# place, so rather than parsing them over and over, we can decode them once
+# when loading. The decoded value of field `foo` is stored in the attribute
+# `_foo`, which templates don't see; it's None if the text couldn't be
+# decoded.
+
+
+def _decode_date(text):
+    y, m, d = [int(x) for x in text.split("/")]
+    return y, m, d
+
+
+def _decode_month(text):
+    y, m = [int(x) for x in text.split("/")]
+    if m < 1 or m > 12:
+        raise ValueError("no such month %d" % m)
+    return y, m
+
+
+def _decode_mypos(text):
+    mypos = int(text)
+    if mypos == 0:
+        raise ValueError("positions count from 1, or back from -1")
+    return mypos
+
+
+def _decode_advpos(text):
+    if not len(text):
+        return []
+    return [int(x) - 1 for x in text.split(",")]
+
+
+def _decode_adscites(text):
+    from time import mktime
+
+    a = text.split()[:2]
+    y, m, d = _decode_date(a[0])
+    return Holder(lastupdate=int(mktime((y, m, d, 0, 0, 0, 0, 0, 0))), cites=int(a[1]))
+
+
+def _decode_amount(text):
+    quantity, units = text.split()
+    return float(quantity), units
+
+
+field_schemas = {
+    "pub": {
+        "mypos": _decode_mypos,
+        "advpos": _decode_advpos,
+        "pubdate": _decode_month,
+        "adscites": _decode_adscites,
+    },
+    "prop": {
+        "award": _decode_amount,
+        "request": _decode_amount,
+    },
+    "repo": {
+        "usercommits": int,
+        "allcommits": int,
+        "stars": int,
+        "forks": int,
+        "lastusercommit": _decode_date,
+    },
+}
+
+
+def _warn_bad_value(path, item, name, text, e, index=None):
+    """Complain that the field `name` of `item` can't be decoded, giving the
+    file and line where it's set if we know which file `item` came from."""
+    from inifile import locateField
+
+    where = path
+    # The records may have been filtered, so they're located by fingerprint
+    # rather than by counting.
+    key = item.get("_fingerprint", index)
+
+    if path is not None and key is not None:
+        lineno = locateField(path, key, name)
+        if lineno is not None:
+            where = "%s:%d" % (path, lineno)
+
+    if where is None:
+        warn('cannot parse %s value "%s": %s', name, text, e)
+    else:
+        warn('%s: cannot parse %s value "%s": %s', where, name, text, e)
+
+
+def _decode_typed(path, items):
+    for index, item in enumerate(items):
+        schema = field_schemas.get(item.section)
+
+        if schema is not None:
+            typed = {}
+
+            for name, decode in schema.items():
+                text = item.get(name)
+                if text is None:
+                    continue
+
+                try:
+                    typed["_" + name] = decode(text)
+                except Exception as e:
+                    _warn_bad_value(path, item, name, text, e, index)
+                    typed["_" + name] = None
+
+            if len(typed):
+                item.set(**typed)
+
+        yield item
+
+
+def typed_value(item, name, default=None, path=None):
+    """Get the decoded value of the field `name` of `item`, as defined by
+    `field_schemas`. If the item was loaded with `typed=True`, this is just a
+    lookup; otherwise the field is decoded now. Returns `default` if the
+    field is missing or can't be decoded. If `path`, the data file that the
+    item was read from, is given, a value that can't be decoded now is
+    reported along with its file and line."""
+    value = item.get("_" + name)
+    if value is not None:
+        return value
+    if item.has("_" + name):
+        return default  # decoding failed, and we've already complained
+
+    text = item.get(name)
+    if text is None:
+        return default
+
+    try:
+        decode = field_schemas[item.section][name]
+    except KeyError:
+        die('no schema for the field "%s" of %s records', name, item.section)
+
+    try:
+        return decode(text)
+    except Exception as e:
+        _warn_bad_value(path, item, name, text, e)
+        return default
+
+
+# Columnar export. For bulk analysis, `wltool export` writes out selected
+# fields of all of the records of one section as typed columns. Each column
+# is `(name, kind, missing, get)`: `kind` is "int", "float", "bool", or
+# "str"; `get(item)` returns the value or None; and `missing` is what's
+# stored in NPZ files when there's no value, since arrays can't hold None.
+
+
+def _export_pubdate(index):
+    def get(item):
+        value = typed_value(item, "pubdate")
+        return None if value is None else value[index]
+
+    return get
+
+
+def _export_date(index):
+    def get(item):
+        text = item.get("date")
+        interval = None if text is None else date_interval(text)
+        return None if interval is None else interval[0][index]
+
+    return get
+
+
+def _export_typed(name, index=None):
+    def get(item):
+        value = typed_value(item, name)
+        if value is None or index is None:
+            return value
+        return value[index]
+
+    return get
 
-    if not any:
-        die('no data files found in directory "%s"', datadir)
 
+def _export_flag(name):
+    return lambda item: item.get(name, "n") == "y"
 
-def load(datadir="."):
-    from inifile import read as iniread
+
+def _export_cites(item):
+    value = typed_value(item, "adscites")
+    return None if value is None else value.cites
+
+
+def _export_nauthors(item):
+    authors = item.get("authors")
+    if authors is None:
+        return None
+    return len([a for a in authors.split(";") if len(a.strip())])
+
+
+export_columns = {
+    "pub": [
+        ("year", "int", 0, _export_pubdate(0)),
+        ("month", "int", 0, _export_pubdate(1)),
+        ("mypos", "int", 0, _export_typed("mypos")),
+        ("refereed", "bool", False, _export_flag("refereed")),
+        ("cites", "int", -1, _export_cites),
+        ("nauthors", "int", 0, _export_nauthors),
+        ("bibcode", "str", "", lambda i: i.get("bibcode")),
+    ],
+    "prop": [
+        ("year", "int", 0, _export_date(0)),
+        ("month", "int", 0, _export_date(1)),
+        ("facil", "str", "", lambda i: i.get("facil")),
+        ("mepi", "bool", False, _export_flag("mepi")),
+        ("accepted", "bool", False, _export_flag("accepted")),
+        ("request", "float", float("nan"), _export_typed("request", 0)),
+        ("request_units", "str", "", _export_typed("request", 1)),
+        ("award", "float", float("nan"), _export_typed("award", 0)),
+        ("award_units", "str", "", _export_typed("award", 1)),
+    ],
+    "repo": [
+        ("name", "str", "", lambda i: i.get("name")),
+        ("service", "str", "", lambda i: i.get("service")),
+        ("usercommits", "int", -1, _export_typed("usercommits")),
+        ("allcommits", "int", -1, _export_typed("allcommits")),
+        ("stars", "int", -1, _export_typed("stars")),
+        ("forks", "int", -1, _export_typed("forks")),
+        ("lastyear", "int", 0, _export_typed("lastusercommit", 0)),
+        ("lastmonth", "int", 0, _export_typed("lastusercommit", 1)),
+        ("lastday", "int", 0, _export_typed("lastusercommit", 2)),
+    ],
+}
+
+_export_typecodes = {"int": "q", "float": "d", "bool": "B"}
+
+
+def export_records(datadir, section, fmt, stream):
+    """Write the `export_columns` of the records of `section` in `datadir` to
+    `stream`, in the format `fmt`. With "csv", there's a header line, then a
+    line for each record, with missing values left empty. With "jsonl",
+    there's a JSON object for each record, with missing values null. Both
+    of those need a text stream and are written as the records are read.
+    With "npz", `stream` must be binary, and gets a NumPy archive of one
+    array for each column, with missing values filled in. The values are
+    accumulated in compact typed buffers until the end. Returns the number
+    of records written."""
+    columns = export_columns.get(section)
+    if columns is None:
+        die(
+            "cannot export %s records; only %s are supported",
+            section,
+            ", ".join(sorted(export_columns)),
+        )
+
+    items = load(datadir, mapped=True, typed=True, sections=section)
+    rows = ([get(item) for _, _, _, get in columns] for item in items)
+    names = [c[0] for c in columns]
+    nrows = 0
+
+    if fmt == "csv":
+        import csv
+
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerow(names)
+
+        for row in rows:
+            writer.writerow(["" if v is None else v for v in row])
+            nrows += 1
+    elif fmt == "jsonl":
+        import json
+
+        for row in rows:
+            print(json.dumps(dict(zip(names, row)), ensure_ascii=False), file=stream)
+            nrows += 1
+    elif fmt == "npz":
+        from array import array
+
+        try:
+            import numpy as np
+        except ImportError:
+            die("exporting in NPZ format requires the numpy module")
+
+        buffers = [
+            array(_export_typecodes[kind]) if kind != "str" else []
+            for _, kind, _, _ in columns
+        ]
+        fills = [missing for _, _, missing, _ in columns]
+
+        for row in rows:
+            for buf, fill, value in zip(buffers, fills, row):
+                buf.append(fill if value is None else value)
+            nrows += 1
+
+        arrays = {}
+
+        for (name, kind, _, _), buf in zip(columns, buffers):
+            if kind == "str":
+                arrays[name] = np.array(buf, dtype=str)
+            elif kind == "bool":
+                arrays[name] = np.frombuffer(buf, dtype=np.uint8).astype(bool)
+            else:
+                arrays[name] = np.frombuffer(buf, dtype=buf.typecode).copy()
+
+        np.savez(stream, **arrays)
+    else:
+        die('unknown export format "%s"; use csv, jsonl, or npz', fmt)
+
+    return nrows
+
+
+def count_sections(datadir="."):
+    """Count the records of each section in the data files in `datadir`
+    without actually parsing them. Returns a tuple `(totals, perfile)`, where
+    `totals` is a dict mapping section names to counts and `perfile` is a
+    list of `(path, counts)` tuples in the same form."""
+    from inifile import scanSections
+
+    totals = {}
+    perfile = []
 
     for path in list_data_files(datadir):
-        for item in iniread(path):
+        counts = scanSections(path)
+        perfile.append((path, counts))
+
+        for section, count in counts.items():
+            totals[section] = totals.get(section, 0) + count
+
+    return totals, perfile
+
+
+def cache_dir(datadir):
+    """Get the directory in which cached information about the data files in
+    `datadir` is stored."""
+    from os.path import join
+
+    return join(datadir, ".wlcache")
+
+
+def clean_cache(datadir=".", everything=False, recursive=None):
+    """Remove stale entries from the record cache of `datadir`, or all of
+    them if `everything`. Returns the number of entries removed.
+
+    If `recursive` (by default, `DATA_RECURSIVE`), the caches of all of the
+    subdirectories that list_data_files() finds data files in are cleaned
+    too, since each directory's files are cached in its own cache
+    directory."""
+    from os.path import dirname
+    from inifile import cleanCache
+
+    if recursive is None:
+        recursive = DATA_RECURSIVE
+
+    dirs = set([datadir])
+
+    if recursive:
+        for path in list_data_files(datadir, recursive=True):
+            dirs.add(dirname(path))
+
+    return sum(
+        cleanCache(cache_dir(d), d, everything=everything) for d in sorted(dirs)
+    )
+
+
+# The record index. `wltool index` keeps a SQLite database of the records in
+# the data files, so that queries don't have to scan all of them. Each file
+# is reindexed when its size or mtime changes, and the index is only used if
+# it covers exactly the current data files, unchanged; otherwise callers fall
+# back to reading the files.
+
+_index_version = 1
+
+_index_schema = """
+CREATE TABLE files (path TEXT PRIMARY KEY, seq INTEGER, mtime INTEGER,
+                    size INTEGER);
+CREATE TABLE records (id INTEGER PRIMARY KEY, path TEXT, seq INTEGER,
+                      section TEXT, fingerprint TEXT, date_field TEXT,
+                      date_lo INTEGER, date_hi INTEGER);
+CREATE TABLE fields (record INTEGER, name TEXT, value TEXT);
+CREATE TABLE authors (record INTEGER, position INTEGER, name TEXT,
+                      surname TEXT);
+CREATE INDEX records_path ON records (path, seq);
+CREATE INDEX records_section ON records (section);
+CREATE INDEX records_date ON records (date_field, date_hi, date_lo);
+CREATE INDEX fields_record ON fields (record);
+CREATE INDEX fields_value ON fields (name, value);
+CREATE INDEX authors_record ON authors (record);
+CREATE INDEX authors_surname ON authors (surname);
+"""
+
+
+def _index_path(datadir):
+    from os.path import join
+
+    # The leading dot keeps clean_cache() from treating it as a record cache
+    # entry.
+    return join(cache_dir(datadir), ".index.sqlite")
+
+
+def _index_stat(path):
+    """Get the `(mtime, size)` of a data file as recorded in the index. The
+    mtime is None if it can't be trusted yet."""
+    import os
+    from inifile import _trustedMtime
+
+    st = os.stat(path)
+    return _trustedMtime(st), st.st_size
+
+
+def _indexed_files(datadir):
+    """List the data files of `datadir` as `(name, path)` tuples, where `name`
+    is the path relative to `datadir`, which is how the index knows them."""
+    from os.path import relpath
+
+    return [(relpath(path, datadir), path) for path in list_data_files(datadir)]
+
+
+def _month_index(month):
+    return month[0] * 12 + month[1] - 1
+
+
+def _index_file(conn, name, path):
+    from inifile import readMapped
+
+    for seq, item in enumerate(readMapped(path)):
+        # Only the first date field that a record has is indexed.
+        date_field = date_lo = date_hi = None
+
+        for field in _date_fields:
+            text = item.get(field)
+            if text is None:
+                continue
+
+            interval = date_interval(text)
+            if interval is not None:
+                date_field = field
+                date_lo = _month_index(interval[0])
+                date_hi = _month_index(interval[1])
+            break
+
+        cursor = conn.execute(
+            "INSERT INTO records (path, seq, section, fingerprint, date_field, "
+            "date_lo, date_hi) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (name, seq, item.section, item._fingerprint, date_field, date_lo, date_hi),
+        )
+        record = cursor.lastrowid
+
+        conn.executemany(
+            "INSERT INTO fields (record, name, value) VALUES (?, ?, ?)",
+            [(record, k, v) for k, v in item.iteritems() if k != "section"],
+        )
+
+        authors = item.get("authors")
+        if authors is not None:
+            names = [a.strip() for a in authors.split(";") if len(a.strip())]
+            conn.executemany(
+                "INSERT INTO authors (record, position, name, surname) "
+                "VALUES (?, ?, ?, ?)",
+                [(record, i, name, surname(name)) for i, name in enumerate(names)],
+            )
+
+
+def _unindex_file(conn, path):
+    ids = "SELECT id FROM records WHERE path = ?"
+    conn.execute("DELETE FROM fields WHERE record IN (%s)" % ids, (path,))
+    conn.execute("DELETE FROM authors WHERE record IN (%s)" % ids, (path,))
+    conn.execute("DELETE FROM records WHERE path = ?", (path,))
+    conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+
+def update_index(datadir=".", rebuild=False):
+    """Bring the record index of `datadir` up to date, creating it if needed,
+    or from scratch if `rebuild`. Only data files that have changed since
+    they were last indexed are read. Returns a tuple `(nindexed, nremoved)`
+    giving the numbers of files that were (re)indexed and that were dropped
+    from the index because they no longer exist."""
+    import os, sqlite3
+
+    dbpath = _index_path(datadir)
+    files = _indexed_files(datadir)
+
+    if rebuild and os.path.exists(dbpath):
+        os.unlink(dbpath)
+    if not os.path.isdir(os.path.dirname(dbpath)):
+        os.makedirs(os.path.dirname(dbpath))
+
+    conn = sqlite3.connect(dbpath)
+
+    try:
+        with conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] != _index_version:
+                tables = conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'"
+                ).fetchall()
+                for (table,) in tables:
+                    conn.execute("DROP TABLE %s" % table)
+
+                conn.executescript(_index_schema)
+                conn.execute("PRAGMA user_version = %d" % _index_version)
+
+        with conn:
+            known = dict(
+                (path, (mtime, size))
+                for path, mtime, size in conn.execute(
+                    "SELECT path, mtime, size FROM files"
+                )
+            )
+            current = set(name for name, _ in files)
+            nindexed = nremoved = 0
+
+            for name in known:
+                if name not in current:
+                    _unindex_file(conn, name)
+                    nremoved += 1
+
+            for seq, (name, path) in enumerate(files):
+                # Take the stat before reading, so that if the file changes
+                # meanwhile, the index will look stale rather than fresh.
+                stat = _index_stat(path)
+                old = known.get(name)
+
+                if old is None or old[0] is None or old != stat:
+                    _unindex_file(conn, name)
+                    _index_file(conn, name, path)
+                    nindexed += 1
+
+                conn.execute(
+                    "INSERT OR REPLACE INTO files (path, seq, mtime, size) "
+                    "VALUES (?, ?, ?, ?)",
+                    (name, seq) + stat,
+                )
+    finally:
+        conn.close()
+
+    return nindexed, nremoved
+
+
+def open_index(datadir="."):
+    """Open the record index of `datadir`, returning a RecordIndex, or None
+    if there's no index or it doesn't reflect the current data files. This
+    still lists and stats all of the data files, but doesn't read them."""
+    import os, sqlite3
+    from urllib.parse import quote
+
+    dbpath = _index_path(datadir)
+
+    if not os.path.exists(dbpath):
+        return None
+
+    try:
+        conn = sqlite3.connect("file:%s?mode=ro" % quote(dbpath), uri=True)
+        if conn.execute("PRAGMA user_version").fetchone()[0] != _index_version:
+            conn.close()
+            return None
+
+        known = dict(
+            (path, (mtime, size))
+            for path, mtime, size in conn.execute("SELECT path, mtime, size FROM files")
+        )
+    except sqlite3.Error:
+        return None
+
+    files = _indexed_files(datadir)
+
+    if len(files) != len(known):
+        conn.close()
+        return None
+
+    for name, path in files:
+        old = known.get(name)
+
+        try:
+            fresh = old is not None and old[0] is not None and old == _index_stat(path)
+        except OSError:
+            fresh = False
+
+        if not fresh:
+            conn.close()
+            return None
+
+    return RecordIndex(conn, datadir)
+
+
+class RecordIndex(object):
+    """A fresh record index, as returned by open_index()."""
+
+    def __init__(self, conn, datadir):
+        self.conn = conn
+        self.datadir = datadir
+
+    def close(self):
+        self.conn.close()
+
+    def records(self, sections=None, window=None, bibcode=None, author=None):
+        """Yield the records in the index, as Holders, in the same order that
+        load() would. The arguments filter them: `sections` and `window` are as
+        for load(), `bibcode` selects records with that bibcode, and `author`
+        ones with an author having that surname. For `window`, only the first
+        of the fields `pubdate` and `date` that a record has is indexed, so
+        that's the only one that it can match."""
+        terms = []
+        args = []
+
+        if sections is not None:
+            if isinstance(sections, string_types):
+                sections = [sections]
+            sections = list(sections)
+            terms.append("r.section IN (%s)" % ", ".join("?" * len(sections)))
+            args += sections
+
+        if window is not None:
+            field, start, end = window
+            terms.append("r.date_field = ?")
+            args.append(field)
+            if start is not None:
+                terms.append("r.date_hi >= ?")
+                args.append(_month_index(start))
+            if end is not None:
+                terms.append("r.date_lo <= ?")
+                args.append(_month_index(end))
+
+        if bibcode is not None:
+            terms.append(
+                "r.id IN (SELECT record FROM fields WHERE name = 'bibcode' AND "
+                "value = ?)"
+            )
+            args.append(bibcode)
+
+        if author is not None:
+            terms.append("r.id IN (SELECT record FROM authors WHERE surname = ?)")
+            args.append(author)
+
+        query = (
+            "SELECT r.id, r.section, v.name, v.value FROM records r "
+            "JOIN files f ON r.path = f.path LEFT JOIN fields v ON v.record = r.id"
+        )
+        if len(terms):
+            query += " WHERE " + " AND ".join(terms)
+        query += " ORDER BY f.seq, r.seq"
+
+        item = current = None
+
+        for record, section, name, value in self.conn.execute(query, args):
+            if record != current:
+                if item is not None:
+                    yield item
+                item = Holder(section=section)
+                current = record
+
+            if name is not None:
+                item.setone(name, value)
+
+        if item is not None:
             yield item
 
+    def count_sections(self):
+        """Return the same `(totals, perfile)` tuple as count_sections()."""
+        from os.path import join
+
+        totals = {}
+        perfile = []
+        byfile = {}
+
+        for path, section, count in self.conn.execute(
+            "SELECT path, section, COUNT(*) FROM records GROUP BY path, section"
+        ):
+            byfile.setdefault(path, {})[section] = count
+            totals[section] = totals.get(section, 0) + count
+
+        for (path,) in self.conn.execute("SELECT path FROM files ORDER BY seq"):
+            perfile.append((join(self.datadir, path), byfile.get(path, {})))
+
+        return totals, perfile
+
+
+# Watching the data files. For `wltool watch`, we keep the records in memory
+# and reread the data files whenever they change, reparsing only the records
+# that were edited.
+
+
+class DataWatcher(object):
+    """Keeps the records of the data files in `datadir` loaded, in the form
+    that setup_processing() would load them. Each call to refresh() checks
+    the data files for changes and updates `items` to match."""
+
+    def __init__(self, datadir="."):
+        self.datadir = datadir
+        self.items = []
+        self._readers = {}
+        self._paths = None
+
+    def refresh(self):
+        """Bring `items` up to date with the data files. Returns whether
+        anything changed. Unchanged files aren't reread at all, and unchanged
+        records of changed files are kept rather than reparsed."""
+        from inifile import IncrementalReader
+
+        paths = list(list_data_files(self.datadir))
+        changed = paths != self._paths
+        readers = {}
+        files = []
+
+        for path in paths:
+            reader = self._readers.get(path)
+            if reader is None:
+                reader = IncrementalReader(path, compact=True)
+
+            old = reader.records
+            records = reader.refresh()
+
+            if records is not old and (
+                len(records) != len(old)
+                or any(a is not b for a, b in zip(records, old))
+            ):
+                changed = True
+
+                # Records that were kept have been decoded already.
+                list(_decode_typed(path, reader.parsed))
+
+            readers[path] = reader
+            files.append(records)
+
+        self._readers = readers
+        self._paths = paths
+
+        if changed:
+            if LOAD_ORDER is None:
+                self.items = [item for records in files for item in records]
+            else:
+                self.items = list(_merge_by_date(files, LOAD_ORDER))
+
+        return changed
+
 
 # Text formatting. We have a tiny DOM-type system for markup so we can
 # abstract across LaTeX and HTML. Initially I tried to do everything in HTML,
@@ -403,60 +1669,63 @@ class Formatter(object):
 
         pieces = split(r"(\|[^|]+\|)", text)
 
-        def process(piece):
+        # Each part is either literal text, escaped now once and for all, or a
+        # tuple `(spec, name, texturl)` describing a substitution.
+        self.parts = []
+
+        for piece in pieces:
             if len(piece) and piece[0] == "|":
-                return True, piece[1:-1]
-            return False, piece
+                spec = piece[1:-1]
+                if spec.startswith("texturl:"):
+                    self.parts.append((spec, spec[8:], True))
+                else:
+                    self.parts.append((spec, spec, False))
+            elif len(piece):
+                self.parts.append(piece if israw else renderer(piece))
 
-        self.tmplinfo = [process(p) for p in pieces]
         self.renderer = renderer
         self.israw = israw
 
-    def _handle_one(self, tmpldata, item):
-        issubst, text = tmpldata
+    def __call__(self, item):
+        renderer = self.renderer
+        get = item.get
+        result = []
 
-        if not issubst:
-            if self.israw:
-                return text
-            return self.renderer(text)
+        for part in self.parts:
+            if not isinstance(part, tuple):
+                result.append(part)
+                continue
 
-        try:
-            if text.startswith("texturl:"):
-                thing = item.get(text[8:])
-                thing = MupLink(thing, thing)
-            else:
-                thing = item.get(text)
-            return self.renderer(thing)
-        except ValueError as e:
-            raise ValueError(
-                ('while rendering field "%s" of item %s: %s' % (text, item, e)).encode(
-                    "utf-8"
-                )
-            )
+            spec, name, texturl = part
 
-    def __call__(self, item):
-        return "".join(self._handle_one(d, item) for d in self.tmplinfo)
+            try:
+                thing = get(name)
+                if texturl:
+                    thing = MupLink(thing, thing)
+                result.append(renderer(thing))
+            except ValueError as e:
+                raise ValueError(
+                    (
+                        'while rendering field "%s" of item %s: %s' % (spec, item, e)
+                    ).encode("utf-8")
+                )
 
+        return "".join(result)
 
-# Utilities for dealing with publications.
 
+@lru_cache(maxsize=128)
+def _cached_formatter(renderer, israw, text):
+    """Get a Formatter, reusing one made earlier for the same arguments if
+    possible, since templates tend to use the same formats over and over.
+    Formatters have no state besides their arguments, so sharing is safe."""
+    return Formatter(renderer, israw, text)
 
-def parse_ads_cites(pub):
-    from time import mktime
 
-    if not pub.has("adscites"):
-        return None
+# Utilities for dealing with publications.
 
-    try:
-        a = pub.adscites.split()[:2]
-        y, m, d = [int(x) for x in a[0].split("/")]
-        lastupdate = int(mktime((y, m, d, 0, 0, 0, 0, 0, 0)))
-        cites = int(a[1])
-    except Exception:
-        warn('cannot parse adscites entry "%s"', pub.adscites)
-        return None
 
-    return Holder(lastupdate=lastupdate, cites=cites)
+def parse_ads_cites(pub):
+    return typed_value(pub, "adscites")
 
 
 def canonicalize_name(name):
@@ -520,19 +1789,18 @@ def cite_info(oitem, context):
     # Canonicalized authors with bolding of self and underlining of advisees.
     cauths = [canonicalize_name(a) for a in oitem.authors.split(";")]
 
-    mypos = int(oitem.mypos)
-    if mypos < 0:
+    mypos = typed_value(oitem, "mypos")
+    if mypos is None:
+        die("illegal mypos value %r" % (oitem.get("mypos"),))
+    elif mypos < 0:
         myidx = len(cauths) + mypos
-    elif mypos == 0:
-        die("illegal mypos value %r" % (oitem.mypos,))
     else:
         myidx = mypos - 1
     cauths[myidx] = MupBold(cauths[myidx])
 
-    advposlist = oitem.get("advpos", "")
-    if len(advposlist):
-        for i in [int(x) - 1 for x in advposlist.split(",")]:
-            cauths[i] = MupUnderline(cauths[i])
+    advpos = typed_value(oitem, "advpos", [])
+    for i in advpos:
+        cauths[i] = MupUnderline(cauths[i])
 
     aitem.full_authors = MupJoin(", ", cauths)
 
@@ -541,9 +1809,8 @@ def cite_info(oitem, context):
     if context.my_abbrev_name is not None:
         sauths[myidx] = context.my_abbrev_name
 
-    if len(advposlist):
-        for i in [int(x) - 1 for x in advposlist.split(",")]:
-            sauths[i] = MupUnderline(sauths[i])
+    for i in advpos:
+        sauths[i] = MupUnderline(sauths[i])
 
     if len(sauths) == 1:
         aitem.short_authors = sauths[0]
@@ -569,7 +1836,7 @@ def cite_info(oitem, context):
         aitem.bold_if_first_title = oitem.title
 
     # Pub year and nicely-formatted date
-    aitem.year, aitem.month = list(map(int, oitem.pubdate.split("/")))
+    aitem.year, aitem.month = typed_value(oitem, "pubdate")
     aitem.pubdate = "%d%s%s" % (aitem.year, nbsp, months[aitem.month - 1])
 
     # Template-friendly citation count
@@ -638,7 +1905,7 @@ def compute_cite_stats(pubs):
     for pub in pubs:
         if pub.refereed == "y":
             stats.refpubs += 1
-            if int(pub.mypos) == 1:
+            if typed_value(pub, "mypos") == 1:
                 stats.reffirstauth += 1
 
         citeinfo = parse_ads_cites(pub)
@@ -727,20 +1994,22 @@ def compute_time_allocations(props):
     allocs = {}
 
     def get_contributions(prop):
-        amount = prop.get("award")
-        if amount is None:
-            amount = prop.get("request")
-        if amount is None:
+        name = "award" if prop.has("award") else "request"
+        if not prop.has(name):
             die('no "award" or "request" for proposal %s', prop)
 
-        try:
-            facil1 = prop.facil
-            quantity1, units1 = amount.split()
-            quantity1 = float(quantity1)
-        except Exception as e:
-            die("error processing primary outcome of proposal <%s>: %s", prop, e)
+        amount = typed_value(prop, name)
+        if amount is None:
+            die(
+                'error processing primary outcome of proposal <%s>: bad "%s"',
+                prop,
+                name,
+            )
+        if not prop.has("facil"):
+            die('error processing primary outcome of proposal <%s>: no "facil"', prop)
 
-        yield facil1, quantity1, units1
+        quantity1, units1 = amount
+        yield prop.facil, quantity1, units1
 
         i = 2
 
@@ -818,12 +2087,24 @@ def process_repositories(items):
         from urllib2 import quote as urlquote
     repos = []
 
+    def required(item, name):
+        value = typed_value(item, name)
+        if value is None:
+            die(
+                'illegal %s value %r for repository "%s"',
+                name,
+                item.get(name),
+                item.get("name"),
+            )
+        return value
+
     for i in items:
         if i.section != "repo":
             continue
         if i.get("skip", "n") == "y":
             continue
-        if i.usercommits == "0":
+        usercommits = required(i, "usercommits")
+        if usercommits == 0:
             continue
 
         repo = i.copy()
@@ -834,13 +2115,12 @@ def process_repositories(items):
         else:
             repo.linkname = i.name
 
-        repo.commit_frac = "%.0f%%" % (100.0 * int(i.usercommits) / int(i.allcommits))
+        allcommits = required(i, "allcommits")
+        repo.commit_frac = "%.0f%%" % (100.0 * usercommits / allcommits)
         if repo.commit_frac == "0%":
             repo.commit_frac = "<1%"
 
-        repo.luc_year, repo.luc_month, repo.luc_day = [
-            int(x) for x in i.lastusercommit.split("/")
-        ]
+        repo.luc_year, repo.luc_month, repo.luc_day = required(i, "lastusercommit")
         repo.date = "%04d %s" % (repo.luc_year, months[repo.luc_month - 1])
         repo._datekey = repo.luc_year * 10000 + repo.luc_month * 100 + repo.luc_day
 
@@ -856,13 +2136,13 @@ def compute_repo_stats(repos):
     pa_forks = 0
 
     for repo in repos:
-        tc += int(repo.usercommits)
+        usercommits = typed_value(repo, "usercommits")
+        tc += usercommits
 
-        if 2 * int(repo.usercommits) > int(
-            repo.allcommits
-        ):  # >=50% of commits ("primary author")?
-            pa_stars += int(repo.get("stars", "0"))
-            pa_forks += int(repo.get("forks", "0"))
+        # >=50% of commits ("primary author")?
+        if 2 * usercommits > typed_value(repo, "allcommits"):
+            pa_stars += typed_value(repo, "stars", 0)
+            pa_forks += typed_value(repo, "forks", 0)
 
     info["total_commits"] = tc
     info["primary_author_stars"] = pa_stars
@@ -908,7 +2188,7 @@ class MultilineSubstHandler(MultilineHandler):
 
     def handle_end_span(self, context):
         tmpl = "\n".join(self.lines)
-        return Formatter(context.render, True, tmpl)(self.info)
+        return _cached_formatter(context.render, True, tmpl)(self.info)
 
 
 def cmd_begin_subst(context, group):
@@ -921,7 +2201,7 @@ def cmd_begin_subst(context, group):
 
 def cmd_format(context, *inline_template):
     inline_template = " ".join(inline_template)
-    context.cur_formatter = Formatter(context.render, True, inline_template)
+    context.cur_formatter = _cached_formatter(context.render, True, inline_template)
     return ""
 
 
@@ -1020,10 +2300,15 @@ def cmd_today(context):
     return context.render(text)
 
 
-def setup_processing(render, datadir):
+def setup_processing(render, datadir, items=None):
+    """Set up to process a template. The records are loaded from `datadir`
+    unless they're given as `items`, e.g. by a DataWatcher."""
+    if items is None:
+        items = load(datadir, compact=True, cache=True, typed=True, order=LOAD_ORDER)
+
     context = Holder()
     context.render = render
-    context.items = list(load(datadir))
+    context.items = list(items)
     context.pubs = [i for i in context.items if i.section == "pub"]
     context.pubgroups = partition_pubs(context.pubs)
     context.props = [i for i in context.items if i.section == "prop"]